@@ -1,26 +1,375 @@
-from flask import Flask, request, Response, render_template
-from bdays import get_birthdays
+import asyncio
+import cProfile
+import json
+import math
+import os
+import time
 
-app = Flask(__name__, static_folder="./dist/", template_folder="./dist")
+from flask import Flask, request, Response, jsonify, g, abort, url_for
+from werkzeug.http import http_date
+import async_bdays
+import metrics
+from async_bdays import get_birthdays_async
+from bdays import MONTH_WINDOW, ScrapeError, check_month_window, warm_up
+from jobs import Job, JobManager, JobQueueFull
+from checkpoints import get_checkpoint_store
+from compression import available_encodings, negotiate_encoding
+from formats import DEFAULT_FORMAT, FORMATS, format_content_type, negotiate_format
+from result_cache import CachedResult, ResultCache, account_key
+from single_flight import AsyncSingleFlight
+from static_files import StaticFiles
+from subscriptions import SubscriptionScheduler, get_subscription_store
+
+app = Flask(__name__, static_folder=None, template_folder="./dist")
+
+# Frontend build, precompressed by static_files.py after `yarn build`
+static_files = StaticFiles(os.path.join(app.root_path, "dist"))
+
+# Runs once in the gunicorn master with --preload (see gunicorn.conf.py), workers inherit the loaded state
+warm_up()
+
+jobs = JobManager()
+results = ResultCache()
+checkpoints = get_checkpoint_store()
+
+# Uses the subscription store opened in the worker, SQLite connections must not be inherited from the master
+subscription_scheduler = SubscriptionScheduler()
+
+# Identical requests arriving while an account is being scraped wait for that scrape instead of starting their own
+scrapes = AsyncSingleFlight("scrape")
+
+# Seconds between keep-alive comments on idle job event streams
+JOB_EVENTS_KEEPALIVE = 15
+
+# Requests with a X-Profile header are profiled into this directory when set. Async views are profiled on the scrape
+# event loop (see async_bdays.submit) and jobs aren't profiled, only their submission.
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+
+
+def get_cached_birthdays(email, password, progress=None, first_month=0, months=MONTH_WINDOW, checkpoint=None,
+                         output_format=DEFAULT_FORMAT):
+    """ Blocking variant of get_cached_birthdays_async, for threads outside the scrape event loop (e.g. jobs) """
+
+    return async_bdays.run(get_cached_birthdays_async(email, password, progress, first_month, months, checkpoint,
+                                                      output_format))
+
+
+async def get_cached_birthdays_async(email, password, progress=None, first_month=0, months=MONTH_WINDOW,
+                                     checkpoint=None, output_format=DEFAULT_FORMAT):
+    """ Returns CachedResult of the account's birthdays in output_format, scraping Facebook only if there is no fresh one.
+        With a checkpoint the scrape is partial, incomplete results are returned but not cached.
+        Runs on the scrape event loop (see async_bdays.submit). """
+
+    key = f"{account_key(email, password)}-{first_month}-{months}-{output_format}"
+    content_type = format_content_type(output_format)
+    result = results.get(key)
+    metrics.increment("bdays_cache_requests_total", cache="result",
+                      result="hit" if result else "miss")
+
+    if result is None and checkpoint is not None:
+        body = await get_birthdays_async(email, password, progress=progress, first_month=first_month, months=months,
+                                         checkpoint=checkpoint, output_format=output_format)
+
+        if checkpoint.complete:
+            result = results.set(key, body, content_type)
+        else:
+            result = CachedResult(body, time.time(), time.time(), content_type=content_type)
+    elif result is None:
+        async def scrape():
+            return results.set(key, await get_birthdays_async(
+                email, password, progress=progress, first_month=first_month, months=months,
+                output_format=output_format), content_type)
+
+        result = await scrapes.do(key, scrape)
+
+    return result
+
+
+def get_checkpoint(body):
+    """ Returns the checkpoint of a partial scrape request, resumed if it has a scrape_id, None for a regular request """
+
+    if not body.get("partial") and not body.get("scrape_id"):
+        return None
+
+    account = account_key(body["email"], body["pass"])
+
+    if not body.get("scrape_id"):
+        return checkpoints.create(account)
+
+    checkpoint = checkpoints.get(body["scrape_id"], account)
+    if checkpoint is None:
+        abort(Response("Unknown or expired scrape id", status=404))
+
+    return checkpoint
+
+
+def get_month_window(body):
+    """ Returns the (first_month, months) window requested in a request body, the default window if none """
+
+    try:
+        first_month = int(body.get("first_month", 0))
+        # Checked before it is used for the default number of months
+        if not 0 <= first_month < MONTH_WINDOW:
+            raise ValueError(f"First month {first_month} is not within the next 12 months")
+        months = int(body.get("months", MONTH_WINDOW - first_month))
+        check_month_window(first_month, months)
+    except (TypeError, ValueError) as e:
+        abort(Response(f"Invalid month window: {e}", status=400))
+
+    return first_month, months
+
+
+def get_output_format():
+    """ Returns the output format of a request, its format query parameter or else negotiated from its Accept header """
+
+    output_format = request.args.get("format")
+
+    if output_format is None:
+        return negotiate_format(request.accept_mimetypes)
+
+    if output_format not in FORMATS:
+        abort(Response(f"Unknown format, use one of {', '.join(FORMATS)}", status=400))
+
+    return output_format
+
+
+def calendar_response(result):
+    """ Response for a CachedResult (of any format), compressed if the client accepts it, 304 if the client already has this version.
+        GET requests may ask for a byte range of the (compressed) body. """
+
+    encoding = negotiate_encoding(request.accept_encodings, [
+        encoding for encoding, _ in available_encodings()])
+    body = result.encoded_body(encoding)
+    etag = f"{result.etag}-{encoding}" if encoding else result.etag
+
+    headers = {
+        "ETag": f'"{etag}"',
+        "Last-Modified": http_date(result.created_at),
+        "Cache-Control": f"private, max-age={max(0, math.floor(result.expires_at - time.time()))}",
+        "Vary": "Accept, Accept-Encoding",
+    }
+    if encoding:
+        headers["Content-Encoding"] = encoding
+
+    if request.if_none_match.contains(etag) or (
+            not request.if_none_match and request.if_modified_since
+            and request.if_modified_since.timestamp() >= math.floor(result.created_at)):
+        return Response(status=304, headers=headers)
+
+    metrics.increment("bdays_response_bytes_total", len(body), encoding=encoding or "identity")
+
+    # Ranges (and If-Range) of GET requests, a POST is always answered in full
+    return Response(body, headers=headers, content_type=f"{result.content_type}; charset=utf-8").make_conditional(
+        request, accept_ranges=True, complete_length=len(body))
 
 
 @app.route("/", methods=["POST"])
-def serve_bdays():
-    return Response(
-        get_birthdays(request.get_json()["email"], request.get_json()["pass"]))
+async def serve_bdays():
+    first_month, months = get_month_window(request.get_json())
+    checkpoint = get_checkpoint(request.get_json())
+    output_format = get_output_format()
+
+    try:
+        # The scrape runs on the process wide scrape event loop along with every other one, this request only waits for it
+        result = await asyncio.wrap_future(async_bdays.submit(get_cached_birthdays_async(
+            request.get_json()["email"], request.get_json()["pass"], first_month=first_month, months=months,
+            checkpoint=checkpoint, output_format=output_format), g.get("profile")))
+    except ScrapeError as e:
+        if checkpoint is None:
+            raise
+
+        # The months completed so far are kept in the checkpoint, the client needs its id to resume it
+        response = scrape_error(e)
+        response.headers["X-Scrape-Id"] = checkpoint.scrape_id
+        response.headers["X-Scrape-Complete"] = "false"
+        return response
+
+    response = calendar_response(result)
+
+    if checkpoint is not None:
+        response.headers["X-Scrape-Id"] = checkpoint.scrape_id
+        response.headers["X-Scrape-Complete"] = "true" if checkpoint.complete else "false"
+
+    return response
+
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    first_month, months = get_month_window(request.get_json())
+    checkpoint = get_checkpoint(request.get_json())
+    output_format = get_output_format()
+
+    try:
+        job = jobs.submit(get_cached_birthdays, request.get_json()["email"], request.get_json()["pass"],
+                          first_month=first_month, months=months, checkpoint=checkpoint, output_format=output_format)
+    except JobQueueFull:
+        return Response("Too many scrapes in progress, try again later", status=503,
+                        headers={"Retry-After": "30"})
+
+    if checkpoint is not None:
+        return jsonify(dict(job.to_dict(), scrape_id=checkpoint.scrape_id)), 202
+
+    return jsonify(job.to_dict()), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return Response(status=404)
+
+    return jsonify(job.to_dict())
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def get_job_events(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return Response(status=404)
+
+    def stream_events():
+        sent = 0
+        while True:
+            events = job.wait_for_events(sent, JOB_EVENTS_KEEPALIVE)
+            if not events:
+                if job.finished:
+                    return
+                yield ": keep-alive\n\n"
+                continue
+
+            for event in events:
+                yield f"event: {event['phase']}\ndata: {json.dumps(event)}\n\n"
+            sent += len(events)
+
+    return Response(stream_events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache"})
+
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def get_job_result(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return Response(status=404)
+
+    if job.status == Job.FAILED:
+        return Response(f"Scrape failed: {job.error}", status=500)
+
+    if job.status != Job.DONE:
+        return jsonify(job.to_dict()), 202
+
+    return calendar_response(job.result)
+
+
+@app.route("/subscriptions", methods=["POST"])
+async def create_subscription():
+    if not get_subscription_store().enabled:
+        return Response("Subscriptions are disabled, SUBSCRIPTIONS_SECRET isn't set", status=503)
+
+    first_month, months = get_month_window(request.get_json())
+    email, password = request.get_json()["email"], request.get_json()["pass"]
+
+    # Scrape once up front, so bad credentials are reported now and the feed has a calendar from the start
+    result = await asyncio.wrap_future(async_bdays.submit(get_cached_birthdays_async(
+        email, password, first_month=first_month, months=months), g.get("profile")))
+
+    token = get_subscription_store().create(email, password, result.body, first_month, months)
+
+    return jsonify(token=token, url=url_for("serve_feed", token=token, _external=True)), 201
+
+
+@app.route("/subscriptions/<token>", methods=["DELETE"])
+def delete_subscription(token):
+    return Response(status=204 if get_subscription_store().delete(token) else 404)
+
+
+@app.route("/feeds/<token>.ics", methods=["GET"])
+def serve_feed(token):
+    """ Precomputed calendar of a subscription, the scheduler keeps it fresh so this never scrapes """
+
+    feed = get_subscription_store().feed(token, negotiate_encoding(
+        request.accept_encodings, [encoding for encoding, _ in available_encodings()]))
+
+    if feed is None:
+        return Response(status=404)
+
+    response = Response(feed.body, content_type="text/calendar; charset=utf-8", headers={
+        "Last-Modified": http_date(feed.refreshed_at),
+        "Cache-Control": f"private, max-age={max(0, math.floor(feed.next_refresh_at - time.time()))}",
+        "Vary": "Accept-Encoding",
+    })
+    response.set_etag(f"{feed.etag}-{feed.encoding}" if feed.encoding else feed.etag)
+    if feed.encoding:
+        response.headers["Content-Encoding"] = feed.encoding
+
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(feed.body))
+
+
+@app.route("/scrapes/<scrape_id>", methods=["GET"])
+def get_scrape_report(scrape_id):
+    checkpoint = checkpoints.get(scrape_id)
+    if checkpoint is None:
+        return Response(status=404)
+
+    return jsonify(checkpoint.to_dict())
 
 
 @app.route("/", methods=["GET"])
 def serve_frontend():
-    return render_template("index.html")
+    return static_files.index_response()
+
+
+@app.route("/<path:filename>", methods=["GET"])
+def serve_static(filename):
+    return static_files.response(filename)
+
+
+@app.route("/metrics", methods=["GET"])
+def serve_metrics():
+    return Response(metrics.export_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+@app.errorhandler(ScrapeError)
+def scrape_error(error):
+    return Response(f"Scrape failed: {error.reason}", status=500)
+
+
+@app.before_request
+def before_request():
+    metrics.start_timings()
+
+    # Not started at import, it wouldn't survive the fork of gunicorn's preloading master
+    subscription_scheduler.ensure_started()
+
+    if PROFILE_DIR and "X-Profile" in request.headers:
+        g.profile = cProfile.Profile()
+
+        # The work of async views is done on the scrape event loop, they hand the profile over to it
+        if not asyncio.iscoroutinefunction(app.view_functions.get(request.endpoint)):
+            g.profile.enable()
 
 
 @app.after_request
 def after_request(response):
+    profile = g.pop("profile", None)
+    if profile:
+        profile.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profile.dump_stats(os.path.join(
+            PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint}-{os.getpid()}.pstats"))
+
+    timings = metrics.current_timings()
+    if timings and timings.entries:
+        response.headers["Server-Timing"] = timings.server_timing()
+
+    # Only the API is used cross-origin
+    if request.endpoint in ("serve_frontend", "serve_static"):
+        return response
+
     header = response.headers
     header['Access-Control-Allow-Origin'] = '*'
-    header['Access-Control-Allow-Methods'] = 'GET,POST'
+    header['Access-Control-Allow-Methods'] = 'GET,POST,DELETE'
     header['Access-Control-Allow-Headers'] = '*'
+    header['Access-Control-Expose-Headers'] = 'X-Scrape-Id, X-Scrape-Complete'
     return response
 
 
@@ -0,0 +1,702 @@
+""" Scrape engine: login, token, locale, month fetches and vanity resolution of any number of scrapes
+    multiplexed on one event loop per process, so a scrape waiting on Facebook costs a coroutine instead of threads.
+    Parsing and the month window are in bdays.py, this module does the I/O. """
+
+import asyncio
+import contextlib
+import http.cookies
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+import aiohttp
+from yarl import URL
+
+import bdays
+import metrics
+from bdays import (ASYNC_BIRTHDAYS_CHUNK_SIZE, ASYNC_BIRTHDAYS_MAX_WORKERS, MONTH_WINDOW,
+                   PROFILE_PAGE_ACCEPT_ENCODING, PROFILE_PAGE_CHUNK_SIZE, PROFILE_PAGE_MAX_BYTES,
+                   PROFILE_PAGE_MAX_WORKERS, STALE_SESSION_REASONS, USER_AGENT, VANITY_RESOLVE_MAX_WORKERS,
+                   BirthdayCardExtractor, MonthWindow, ProfilePageScanner, ScrapeContext, ScrapeError,
+                   append_birthday_card, check_login_response, drop_unresolved_birthdays, failure_reason,
+                   find_composer_query_entity_id, get_locale_date_parser, is_login_url, parse_async_token,
+                   parse_composer_query_entries, parse_datr_token, parse_facebook_locale, record_profile_page_scan)
+from formats import DEFAULT_FORMAT, serialize_birthdays
+from rate_limit import get_rate_limiter
+from result_cache import account_key
+from single_flight import AsyncSingleFlight
+from transport import (TRANSPORT_BACKOFF_FACTOR, TRANSPORT_BACKOFF_JITTER, TRANSPORT_CONNECT_TIMEOUT,
+                       TRANSPORT_POOL_MAXSIZE, TRANSPORT_READ_TIMEOUT, TRANSPORT_RETRIES, TRANSPORT_RETRY_METHODS,
+                       TRANSPORT_RETRY_STATUSES, endpoint_name)
+from vanity_cache import MISS, get_vanity_cache
+
+# Connections the event loop keeps open at once (all hosts), per host it is TRANSPORT_POOL_MAXSIZE
+ASYNC_CONNECTION_LIMIT = int(os.environ.get('ASYNC_CONNECTION_LIMIT', 256))
+
+month_fetches = AsyncSingleFlight('month')
+composer_query_lookups = AsyncSingleFlight('composer_query')
+profile_page_lookups = AsyncSingleFlight('profile_page')
+
+# Sessions of finished scrapes waiting for their shared calls before closing (see AsyncScrapeContext.close)
+closing_sessions = set()
+
+
+# Event loop
+
+
+__loop = None
+__loop_lock = threading.Lock()
+__connector = None
+
+
+def get_event_loop():
+    """ Returns the process wide scrape event loop, running in a daemon thread started on first use
+        (so not in the gunicorn master, where it wouldn't survive the fork) """
+
+    global __loop
+
+    with __loop_lock:
+        if __loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever,
+                             name='scrape-event-loop', daemon=True).start()
+            __loop = loop
+
+    return __loop
+
+
+def _forget_event_loop():
+    global __loop, __loop_lock, __connector
+
+    # Only the forking thread survives a fork, the child starts its own loop and connections
+    __loop = None
+    __loop_lock = threading.Lock()
+    __connector = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_event_loop)
+
+
+def submit(coroutine, profile=None):
+    """ Run coroutine on the scrape event loop, returns a concurrent.futures.Future of its result.
+        Phase timings of the calling thread's request are reported to by the coroutine as well.
+        With a cProfile.Profile the loop thread is profiled until the coroutine is done, which includes
+        every other task the loop runs meanwhile, so only one coroutine may be profiled at a time. """
+
+    return asyncio.run_coroutine_threadsafe(_with_timings(coroutine, metrics.current_timings(), profile),
+                                            get_event_loop())
+
+
+def run(coroutine):
+    """ Run coroutine on the scrape event loop and block until it is done, returns its result """
+
+    return submit(coroutine).result()
+
+
+async def _with_timings(coroutine, timings, profile=None):
+    metrics.use_timings(timings)
+
+    if profile is None:
+        return await coroutine
+
+    profile.enable()
+    try:
+        return await coroutine
+    finally:
+        profile.disable()
+
+
+def get_connector():
+    """ Returns the connection pool shared by every session of the event loop """
+
+    global __connector
+
+    if __connector is None or __connector.closed:
+        __connector = aiohttp.TCPConnector(
+            limit=ASYNC_CONNECTION_LIMIT, limit_per_host=TRANSPORT_POOL_MAXSIZE)
+
+    return __connector
+
+
+def create_session():
+    """ aiohttp session of one scrape, with its own cookies on the shared connection pool """
+
+    return aiohttp.ClientSession(connector=get_connector(), connector_owner=False,
+                                 # Facebook cookies are also set for the fake server of the benchmarks
+                                 cookie_jar=aiohttp.CookieJar(unsafe=True),
+                                 headers={'User-Agent': USER_AGENT},
+                                 timeout=aiohttp.ClientTimeout(sock_connect=TRANSPORT_CONNECT_TIMEOUT,
+                                                               sock_read=TRANSPORT_READ_TIMEOUT))
+
+
+# Transport
+
+
+@contextlib.asynccontextmanager
+async def request(context, method, url, **kwargs):
+    """ Send a request of the scrape of context, yields the response.
+        Every attempt waits for the rate limit of its endpoint and idempotent requests are retried
+        (with jittered exponential backoff) on connection errors and transient statuses. """
+
+    endpoint = endpoint_name(url)
+    retries = TRANSPORT_RETRIES if method in TRANSPORT_RETRY_METHODS else 0
+
+    for attempt in range(retries + 1):
+        await get_rate_limiter().acquire(endpoint, context.account)
+
+        started = time.perf_counter()
+        status = 'error'
+
+        try:
+            response = await context.session.request(method, url, **kwargs)
+            status = str(response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+            response = None
+        finally:
+            metrics.observe('bdays_outbound_request_seconds',
+                            time.perf_counter() - started, endpoint=endpoint)
+            metrics.increment('bdays_outbound_requests_total',
+                              endpoint=endpoint, status=status)
+
+        if response is not None and (response.status not in TRANSPORT_RETRY_STATUSES or attempt == retries):
+            break
+
+        if response is not None:
+            response.release()
+
+        await asyncio.sleep(TRANSPORT_BACKOFF_FACTOR * 2 ** attempt +
+                            random.uniform(0, TRANSPORT_BACKOFF_JITTER))
+
+    try:
+        yield response
+    finally:
+        response.release()
+
+
+async def fetch_text(context, url):
+    """ GET url, returns (status, text) """
+
+    async with request(context, 'GET', url) as response:
+        return response.status, await response.text()
+
+
+def import_cookies(cookie_jar, requests_cookie_jar):
+    """ Add the cookies of a requests cookie jar (e.g. of the session store) to an aiohttp cookie jar """
+
+    for cookie in requests_cookie_jar:
+        domain = cookie.domain.lstrip('.')
+        morsels = http.cookies.SimpleCookie()
+        morsels[cookie.name] = cookie.value
+        morsels[cookie.name]['domain'] = cookie.domain
+        morsels[cookie.name]['path'] = cookie.path or '/'
+        if cookie.secure:
+            morsels[cookie.name]['secure'] = True
+
+        cookie_jar.update_cookies(morsels, URL.build(scheme='https', host=domain))
+
+
+def export_cookies(cookie_jar):
+    """ Returns the cookies of an aiohttp cookie jar as a requests cookie jar (e.g. for the session store) """
+
+    import requests
+
+    requests_cookie_jar = requests.cookies.RequestsCookieJar()
+
+    for morsel in cookie_jar:
+        requests_cookie_jar.set_cookie(requests.cookies.create_cookie(
+            name=morsel.key, value=morsel.value, domain=morsel['domain'], path=morsel['path'] or '/',
+            secure=bool(morsel['secure'])))
+
+    return requests_cookie_jar
+
+
+# Login
+
+
+class AsyncScrapeContext(ScrapeContext):
+    """ ScrapeContext of an aiohttp session.
+        The async token and locale are fetched by fetch_locale, which has to be awaited before anything reads them. """
+
+    def __init__(self, session, progress=None, account=None, checkpoint=None):
+        super().__init__(progress, account, checkpoint)
+        self.session = session
+        self._fetch_lock = asyncio.Lock()
+        # Calls of single_flight this scrape started or joined, the ones it started use its session
+        self._shared_calls = set()
+
+    async def shared_call(self, single_flight, key, fn, *args):
+        """ Returns await single_flight.do(key, fn, self, *args), see AsyncSingleFlight """
+
+        task = single_flight.start(key, fn, self, *args)
+        self._shared_calls.add(task)
+        task.add_done_callback(self._shared_calls.discard)
+
+        return await asyncio.shield(task)
+
+    async def close(self):
+        """ Close the session, in the background once the shared calls are done if other scrapes may still wait for them """
+
+        if self._shared_calls:
+            closing = asyncio.ensure_future(self._close_after(list(self._shared_calls)))
+            closing_sessions.add(closing)
+            closing.add_done_callback(closing_sessions.discard)
+        else:
+            await self.session.close()
+
+    async def _close_after(self, tasks):
+        await asyncio.wait(tasks)
+        await self.session.close()
+
+    async def fetch_async_token(self):
+        async with self._fetch_lock:
+            if self._async_token is None:
+                with metrics.timed('async_token', self.timings):
+                    self._async_token = await get_async_token(self)
+        return self._async_token
+
+    async def fetch_locale(self):
+        async_token = await self.fetch_async_token()
+        async with self._fetch_lock:
+            if self._locale is None:
+                with metrics.timed('locale', self.timings):
+                    self._locale = await get_facebook_locale(self, async_token)
+        return self._locale
+
+
+async def facebook_login(context, email, password, session_store=None):
+    """ Reuse the stored session of the account if it is still valid, otherwise authenticate and store the new session """
+
+    if session_store is None:
+        from session_store import get_session_store
+        session_store = get_session_store()
+
+    loop = asyncio.get_running_loop()
+
+    # Stored sessions are decrypted with a key stretched from the password, keep that CPU work off the event loop
+    stored_session = await loop.run_in_executor(None, session_store.load, email, password)
+    metrics.increment('bdays_cache_requests_total', cache='session',
+                      result='hit' if stored_session else 'miss')
+
+    if stored_session:
+        cookie_jar, async_token = stored_session
+        import_cookies(context.session.cookie_jar, cookie_jar)
+
+        # Probe the session with the locale request, which is needed for parsing anyway
+        try:
+            context.restore(async_token, await get_facebook_locale(context, async_token))
+            return
+        except ScrapeError as e:
+            # A transient failure doesn't say anything about the session, keep it for the next attempt
+            if e.reason not in STALE_SESSION_REASONS:
+                raise
+            context.session.cookie_jar.clear()
+            await loop.run_in_executor(None, session_store.delete, email)
+
+    await facebook_authenticate(context, email, password)
+    await loop.run_in_executor(None, session_store.save, email, password,
+                               export_cookies(context.session.cookie_jar), await context.fetch_async_token())
+
+
+async def facebook_authenticate(context, email, password):
+    """ Authenticate with Facebook setting up session for further requests """
+
+    import bs4
+
+    FACEBOOK_LOGIN_URL = f'{bdays.FACEBOOK_URL}/login.php'
+
+    # Add 'datr' cookie to session for countries adhering to GDPR compliance
+    status, text = await fetch_text(context, FACEBOOK_LOGIN_URL)
+
+    if status != 200:
+        raise ScrapeError('login_page_status')
+
+    _js_datr = parse_datr_token(text)
+
+    datr_cookies = http.cookies.SimpleCookie()
+    for name in ('datr', '_js_datr'):
+        datr_cookies[name] = _js_datr
+        datr_cookies[name]['domain'] = '.facebook.com'
+        datr_cookies[name]['path'] = '/'
+    context.session.cookie_jar.update_cookies(
+        datr_cookies, URL('https://www.facebook.com/'))
+
+    # Perform main login now
+    async with request(context, 'GET', FACEBOOK_LOGIN_URL) as login_page:
+        if login_page.status != 200:
+            raise ScrapeError('login_page_status')
+
+        login_page_url = str(login_page.url)
+        login_soup = bs4.BeautifulSoup(await login_page.text(), 'lxml')
+
+    login_form = login_soup.find('form', {'id': 'login_form'})
+    login_form.find('input', {'id': 'email'})['value'] = email
+    login_form.find('input', {'id': 'pass'})['value'] = password
+
+    async with request(context, login_form.get('method', 'POST').upper(),
+                       urllib.parse.urljoin(
+                           login_page_url, login_form.get('action', '')),
+                       data=login_form_data(login_form)) as login_response:
+        if login_response.status != 200:
+            raise ScrapeError('login_status')
+
+        check_login_response(bs4.BeautifulSoup(await login_response.text(), 'lxml'))
+
+
+def login_form_data(form):
+    """ Returns list of (name, value) the browser would submit for a (BeautifulSoup) form with its first submit button """
+
+    data = []
+    submitted = False
+
+    for field in form.find_all(['input', 'button', 'textarea', 'select']):
+        name = field.get('name')
+        if not name or field.has_attr('disabled'):
+            continue
+
+        field_type = field.get('type', 'submit' if field.name == 'button' else 'text').lower()
+
+        if field_type in ('submit', 'image'):
+            if not submitted:
+                data.append((name, field.get('value', '')))
+                submitted = True
+        elif field_type in ('checkbox', 'radio'):
+            if field.has_attr('checked'):
+                data.append((name, field.get('value', 'on')))
+        elif field.name == 'textarea':
+            data.append((name, field.text))
+        elif field.name == 'select':
+            option = field.find('option', selected=True) or field.find('option')
+            if option is not None:
+                data.append((name, option.get('value', option.text)))
+        elif field_type not in ('reset', 'button', 'file'):
+            data.append((name, field.get('value', '')))
+
+    return data
+
+
+async def get_async_token(context):
+    """ Get async authorization token (CSRF protection token) that must be included in all async requests.
+        Use AsyncScrapeContext.fetch_async_token to get the token memoized for the session. """
+
+    status, text = await fetch_text(context, f'{bdays.FACEBOOK_URL}/events/birthdays/')
+
+    if status != 200:
+        raise ScrapeError('async_token_status')
+
+    return parse_async_token(text)
+
+
+async def get_facebook_locale(context, async_token):
+    """ Returns users Facebook locale.
+        Use AsyncScrapeContext.fetch_locale to get the locale memoized for the session. """
+
+    # Not all fields are required for response to be given, required fields are fb_dtsg_ag and __a
+    query_params = {'fb_dtsg_ag': async_token,
+                    '__a': '1'}
+
+    async with request(context, 'GET', f'{bdays.FACEBOOK_URL}/ajax/settings/language/account.php?' +
+                       urllib.parse.urlencode(query_params)) as response:
+        if is_login_url(response.url):
+            raise ScrapeError('login_required')
+
+        if response.status != 200:
+            raise ScrapeError('locale_status')
+
+        text = await response.text()
+
+    return parse_facebook_locale(text)
+
+
+# Months
+
+
+async def get_async_birthdays_by_month(context, epoch_timestamps, max_workers=ASYNC_BIRTHDAYS_MAX_WORKERS):
+    """ Returns a list of birthday objects for each month of epoch_timestamps by querying the Facebook birthday async page.
+        Up to max_workers months are fetched concurrently over the same logged in session.
+        Each month is parsed while it arrives but the result is always in month order.
+        With a context.checkpoint (partial scrape) failures are recorded in it instead of raised:
+        failed months are None and cards or vanity names that failed are left out of their month. """
+
+    checkpoint = context.checkpoint
+    partial = checkpoint is not None
+
+    # Fetch token and locale tables up front so month requests and parsing never wait on each other
+    await context.fetch_locale()
+    # Build the tooltip parser of the locale (and load its Babel data) before the first card needs it
+    get_locale_date_parser(context.locale)
+
+    birthdays_by_month = [[] for _ in epoch_timestamps]
+    semaphore = asyncio.Semaphore(max(1, max_workers))
+
+    async def fetch_month(index, epoch_timestamp):
+        async with semaphore:
+            with metrics.timed('month', context.timings, month=index):
+                try:
+                    if context.account is not None:
+                        # Share the month with a concurrent scrape of the same account
+                        key = (context.account, epoch_timestamp, partial)
+                        return index, await context.shared_call(month_fetches, key, fetch_async_birthdays_month,
+                                                                epoch_timestamp, partial), None
+                    return index, await fetch_async_birthdays_month(context, epoch_timestamp, partial), None
+                except Exception as e:
+                    return index, None, e
+
+    month_tasks = [asyncio.ensure_future(fetch_month(index, epoch_timestamp))
+                   for index, epoch_timestamp in enumerate(epoch_timestamps)]
+
+    try:
+        for completed, next_month in enumerate(asyncio.as_completed(month_tasks), 1):
+            index, result, error = await next_month
+            epoch_timestamp = epoch_timestamps[index]
+
+            if error is not None:
+                if not partial:
+                    raise error
+                checkpoint.add_failure('month', failure_reason(error), epoch_timestamp)
+                birthdays_by_month[index] = None
+                continue
+
+            birthdays_by_month[index], card_failures = result
+
+            for reason, name in card_failures:
+                checkpoint.add_failure('card', reason, epoch_timestamp, name)
+
+            context.report_progress('month', month=epoch_timestamp,
+                                    birthdays=len(birthdays_by_month[index]),
+                                    completed=completed, total=len(month_tasks))
+    finally:
+        # A failed month fails the scrape, don't keep fetching the rest
+        for month_task in month_tasks:
+            month_task.cancel()
+
+    birthdays = [birthday for birthdays_for_month in birthdays_by_month if birthdays_for_month is not None
+                 for birthday in birthdays_for_month]
+
+    # Resolve vanity names of all months in one batch
+    with metrics.timed('resolve', context.timings):
+        await resolve_birthday_uids(context, birthdays)
+    context.report_progress('resolve', birthdays=len(birthdays))
+
+    if partial:
+        drop_unresolved_birthdays(
+            checkpoint, epoch_timestamps, birthdays_by_month)
+
+    return birthdays_by_month
+
+
+async def fetch_async_birthdays_month(context, epoch_timestamp, partial=False):
+    """ Returns (birthdays, card failures) of the month starting at epoch_timestamp, parsed while it streams in """
+
+    # Not all fields are required for response to be given, required fields are date, fb_dtsg_ag and __a
+    query_params = {'date': epoch_timestamp,
+                    'fb_dtsg_ag': context.async_token,
+                    '__a': '1'}
+
+    birthdays = []
+    card_failures = [] if partial else None
+    extractor = BirthdayCardExtractor()
+
+    async with request(context, 'GET', f'{bdays.FACEBOOK_URL}/async/birthdays/?' +
+                       urllib.parse.urlencode(query_params)) as response:
+        if response.status != 200:
+            raise ScrapeError('async_birthdays_status')
+
+        async for chunk in response.content.iter_chunked(ASYNC_BIRTHDAYS_CHUNK_SIZE):
+            for card_html in extractor.feed(chunk):
+                append_birthday_card(context, birthdays, card_failures, card_html)
+
+    for card_html in extractor.finish():
+        append_birthday_card(context, birthdays, card_failures, card_html)
+
+    if not extractor.saw_card_html:
+        raise ScrapeError('async_birthdays_response_invalid')
+
+    return birthdays, card_failures or []
+
+
+# Vanity names
+
+
+async def resolve_birthday_uids(context, birthdays, max_workers=VANITY_RESOLVE_MAX_WORKERS,
+                                profile_page_max_workers=PROFILE_PAGE_MAX_WORKERS):
+    """ Fill in the uid of birthdays that only have a vanity name.
+        Vanity names are deduplicated and looked up in the vanity cache first. The rest are resolved with the
+        composer query (at most max_workers at once), names it can't resolve fall back to scraping the profile page
+        (at most profile_page_max_workers at once) so the slow path doesn't hold up the fast one.
+        In a partial scrape (context.checkpoint) unresolved birthdays are left without a uid instead of raising
+        and lookups that failed with an error aren't cached, so a retry looks them up again. """
+
+    partial = context.checkpoint is not None
+
+    vanity_names = {
+        birthday.vanity_name for birthday in birthdays if birthday.uid is None}
+
+    if not vanity_names:
+        return
+
+    loop = asyncio.get_running_loop()
+    vanity_cache = get_vanity_cache()
+
+    # SQLite may wait for other processes' writes, keep it off the event loop
+    cached_entity_ids = await loop.run_in_executor(
+        None, lambda: {vanity_name: vanity_cache.get(vanity_name) for vanity_name in vanity_names})
+    entity_ids = {vanity_name: entity_id for vanity_name, entity_id in cached_entity_ids.items()
+                  if entity_id is not MISS}
+
+    uncached_vanity_names = vanity_names - entity_ids.keys()
+    failed_vanity_names = set()
+
+    composer_query_semaphore = asyncio.Semaphore(max(1, max_workers))
+    profile_page_semaphore = asyncio.Semaphore(max(1, profile_page_max_workers))
+
+    async def resolve(vanity_name):
+        try:
+            async with composer_query_semaphore:
+                entity_id = await context.shared_call(composer_query_lookups, vanity_name,
+                                                      get_entity_id_from_composer_query, vanity_name)
+        except Exception:
+            if not partial:
+                raise
+            # Fall back to the profile page, as for a failed composer query
+            entity_id = None
+
+        if not entity_id:
+            try:
+                async with profile_page_semaphore:
+                    entity_id = await context.shared_call(profile_page_lookups, vanity_name,
+                                                          get_entity_id_from_profile_page, vanity_name)
+            except Exception:
+                if not partial:
+                    raise
+                entity_id = None
+                failed_vanity_names.add(vanity_name)
+
+        entity_ids[vanity_name] = str(entity_id) if entity_id else None
+
+    if uncached_vanity_names:
+        resolve_tasks = [asyncio.ensure_future(resolve(vanity_name))
+                         for vanity_name in uncached_vanity_names]
+        try:
+            await asyncio.gather(*resolve_tasks)
+        finally:
+            for resolve_task in resolve_tasks:
+                resolve_task.cancel()
+
+        await loop.run_in_executor(None, lambda: [vanity_cache.set(vanity_name, entity_ids[vanity_name])
+                                                  for vanity_name in uncached_vanity_names - failed_vanity_names])
+
+    for birthday in birthdays:
+        if birthday.uid is None:
+            birthday.uid = entity_ids[birthday.vanity_name]
+
+            # Failure
+            if not birthday.uid and not partial:
+                raise ScrapeError('vanity_name_unresolved')
+
+
+async def get_entity_id_from_composer_query(context, vanity_name):
+    """ Get entity id of a vanity name from the composer query endpoint """
+
+    # Not all fields are required for response to be given, required fields are value, fb_dtsg_ag and __a
+    query_params = {'value': vanity_name,
+                    'fb_dtsg_ag': context.async_token,
+                    '__a': '1'}
+
+    status, text = await fetch_text(context, f'{bdays.FACEBOOK_URL}/ajax/mercury/composer_query.php?' +
+                                    urllib.parse.urlencode(query_params))
+
+    if status != 200:
+        return None
+
+    return find_composer_query_entity_id(parse_composer_query_entries(text), vanity_name)
+
+
+async def get_entity_id_from_profile_page(context, vanity_name):
+    """ Get entity id from a users profile page, streamed and dropped as soon as the entity id shows up """
+
+    started = time.perf_counter()
+    read_bytes = 0
+
+    # The scanner decompresses the page itself so bytes are counted as transferred, like Content-Length and the budget
+    async with request(context, 'GET', f'{bdays.FACEBOOK_MOBILE_URL}/{vanity_name}', auto_decompress=False,
+                       headers={'Accept-Encoding': PROFILE_PAGE_ACCEPT_ENCODING}) as response:
+        # Server errors and throttling are transient, raise so the lookup isn't cached as failed
+        if response.status >= 500 or response.status == 429:
+            raise ScrapeError('profile_page_status')
+
+        if response.status != 200:
+            return None
+
+        scanner = ProfilePageScanner(
+            response.charset, response.headers.get('Content-Encoding'))
+
+        async for chunk in response.content.iter_chunked(PROFILE_PAGE_CHUNK_SIZE):
+            read_bytes += len(chunk)
+            if scanner.feed(chunk) or read_bytes >= PROFILE_PAGE_MAX_BYTES:
+                # Drop the connection instead of reading the rest of the page
+                response.close()
+                break
+
+        record_profile_page_scan(started, read_bytes, response.headers.get(
+            'Content-Length', ''), scanner.entity_id)
+
+    return scanner.entity_id
+
+
+# Entry point
+
+
+async def get_birthdays_async(email, password, max_workers=ASYNC_BIRTHDAYS_MAX_WORKERS, progress=None,
+                              first_month=0, months=MONTH_WINDOW, checkpoint=None, output_format=DEFAULT_FORMAT):
+    """ Scrape birthdays serialized into output_format (see formats.py), an ics calendar by default.
+        See scrape_birthdays_async for the other arguments. """
+
+    birthdays = await scrape_birthdays_async(email, password, max_workers, progress,
+                                             first_month, months, checkpoint)
+
+    with metrics.timed('serialize'):
+        return serialize_birthdays(birthdays, output_format)
+
+
+async def scrape_birthdays_async(email, password, max_workers=ASYNC_BIRTHDAYS_MAX_WORKERS, progress=None,
+                                 first_month=0, months=MONTH_WINDOW, checkpoint=None):
+    """ Scrape birthdays, returns list of birthday objects in month order.
+        Only the months first_month..first_month + months (0 being the current month) are included.
+        Months still fresh in the month cache are not fetched again, Facebook isn't even logged into if all of them are.
+        progress is called with a dict describing each completed phase (cache, login, every month, vanity resolution).
+        With a checkpoint (see checkpoints.py) the scrape is partial: failed months, cards and vanity names are
+        recorded in it and left out of the result instead of failing the scrape, completed months are kept in it
+        so resuming the same checkpoint only fetches the months that failed.
+        Must run on the scrape event loop (see submit), where it can be awaited by any number of other scrapes. """
+
+    account = account_key(email, password)
+    window = MonthWindow(account, first_month, months, checkpoint)
+
+    context = AsyncScrapeContext(None, progress, account, checkpoint)
+    context.report_progress('cache', cached=len(window.birthdays_by_month),
+                            stale=len(window.stale_epoch_timestamps))
+
+    try:
+        if window.stale_epoch_timestamps:
+            context.session = create_session()
+            try:
+                # Attempt login, reusing a stored session when possible
+                with metrics.timed('login', context.timings):
+                    await facebook_login(context, email, password)
+                context.report_progress('login')
+
+                # Get birthday objects of the stale months via async endpoint
+                window.add_fetched_months(await get_async_birthdays_by_month(
+                    context, window.stale_epoch_timestamps, max_workers))
+            finally:
+                await context.close()
+
+        return window.birthdays()
+    except ScrapeError as e:
+        metrics.increment('bdays_scrape_failures_total', reason=e.reason)
+        raise
@@ -0,0 +1,161 @@
+""" Scrape the calendars of many accounts at once through a process pool
+
+    python batch.py accounts.csv --output-dir calendars
+
+    accounts.csv has an email,password row per account (a `-` reads it from stdin), rows without a password are
+    reported as failed.
+    Every calendar is written to <output dir>/<email>.ics, a summary of the run to <output dir>/summary.json.
+    Outbound rate limits are per process unless RATE_LIMIT_STATE_DIR is set (see rate_limit.py).
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import metrics
+from bdays import MONTH_WINDOW, ScrapeError, check_month_window, get_birthdays, warm_up
+
+SUMMARY_FILE_NAME = 'summary.json'
+
+
+def read_accounts(accounts_file):
+    """ Returns list of (email, password) of a CSV file, skipping blank lines and lines starting with #.
+        The password of a line without one is None, run_batch reports it instead of failing the whole batch. """
+
+    return [(row[0].strip(), row[1] if len(row) > 1 else None) for row in csv.reader(accounts_file)
+            if row and row[0].strip() and not row[0].startswith('#')]
+
+
+def calendar_file_name(email):
+    """ File name of the calendar of an account, safe on every platform """
+
+    return re.sub(r'[^\w.@+-]', '_', email.strip().lower()) + '.ics'
+
+
+def write_atomically(path, text):
+    """ Write text to path through a temporary file in the same directory so readers never see a partial file """
+
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as output_file:
+            output_file.write(text)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def scrape_account(email, password, output_dir, first_month=0, months=MONTH_WINDOW):
+    """ Scrape one account in a pool process and write its calendar, returns its summary entry.
+        Every scrape logs in with its own browser and session, failures are reported instead of raised. """
+
+    timings = metrics.start_timings()
+    started = time.perf_counter()
+    summary = {'email': email, 'file': calendar_file_name(email)}
+
+    try:
+        calendar = get_birthdays(
+            email, password, first_month=first_month, months=months)
+        write_atomically(os.path.join(output_dir, summary['file']), calendar)
+        summary.update(status='ok', events=calendar.count('BEGIN:VEVENT'))
+    except ScrapeError as e:
+        summary.update(status='failed', error=e.reason)
+    except Exception as e:
+        summary.update(status='failed', error=type(e).__name__)
+
+    summary['seconds'] = round(time.perf_counter() - started, 3)
+    summary['phases'] = {name: round(seconds, 3)
+                         for name, seconds in timings.entries}
+
+    return summary
+
+
+def run_batch(accounts, output_dir, workers=None, first_month=0, months=MONTH_WINDOW, on_done=None):
+    """ Scrape accounts with a pool of worker processes, returns the summary of the run.
+        on_done is called with the summary entry of every account as soon as it is finished. """
+
+    os.makedirs(output_dir, exist_ok=True)
+    started = time.perf_counter()
+    results = []
+
+    # Nothing to scrape for a line without a password, only that account fails
+    for email, password in accounts:
+        if not password:
+            results.append({'email': email, 'file': calendar_file_name(email), 'status': 'failed',
+                            'error': 'password_missing', 'seconds': 0, 'phases': {}})
+            if on_done:
+                on_done(results[-1])
+
+    # Every worker process loads the heavy dependencies and locale tables once, not for every account
+    with ProcessPoolExecutor(max_workers=workers, initializer=warm_up) as executor:
+        futures = [executor.submit(scrape_account, email, password, output_dir, first_month, months)
+                   for email, password in accounts if password]
+
+        for future in as_completed(futures):
+            results.append(future.result())
+            if on_done:
+                on_done(results[-1])
+
+    seconds = [result['seconds'] for result in results]
+    summary = {
+        'accounts': len(results),
+        'succeeded': sum(1 for result in results if result['status'] == 'ok'),
+        'failed': sum(1 for result in results if result['status'] != 'ok'),
+        'seconds': round(time.perf_counter() - started, 3),
+        'account_seconds_max': max(seconds, default=0),
+        'account_seconds_total': round(sum(seconds), 3),
+        'results': sorted(results, key=lambda result: result['email']),
+    }
+
+    write_atomically(os.path.join(output_dir, SUMMARY_FILE_NAME),
+                     json.dumps(summary, indent=2, ensure_ascii=False))
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('accounts', type=argparse.FileType('r', encoding='utf-8'),
+                        help='CSV file of email,password rows')
+    parser.add_argument('-o', '--output-dir', default='calendars')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--first-month', type=int, default=0,
+                        help='first month to scrape, 0 being the current one')
+    parser.add_argument('--months', type=int, default=MONTH_WINDOW)
+    args = parser.parse_args()
+
+    try:
+        check_month_window(args.first_month, args.months)
+    except ValueError as e:
+        parser.error(str(e))
+
+    with args.accounts:
+        accounts = read_accounts(args.accounts)
+
+    def print_result(result):
+        outcome = f'{result["events"]} events' if result['status'] == 'ok' else result['error']
+        print(f'{result["email"]:<40} {result["status"]:<7} {result["seconds"]:8.2f}s  {outcome}')
+
+    summary = run_batch(accounts, args.output_dir, args.workers,
+                        args.first_month, args.months, print_result)
+
+    print(f'{summary["succeeded"]}/{summary["accounts"]} accounts in {summary["seconds"]:.2f}s, '
+          f'summary in {os.path.join(args.output_dir, SUMMARY_FILE_NAME)}')
+
+    return 0 if summary['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -21,35 +21,192 @@ import os
 import sys
 import platform
 import re
-import mechanicalsoup
-import requests
 import urllib.parse
-from bs4 import BeautifulSoup
-from datetime import datetime, timedelta
-from dateutil.relativedelta import relativedelta
-from babel import Locale
-from babel.core import UnknownLocaleError
-from babel.dates import format_date
+from datetime import date, datetime, timedelta
+from calendar import isleap, monthrange
 import html
+import codecs
 import locale
-import pytz
 import json
-import ics
-from ics import Calendar, Event
 import configparser
 import logging
-from distutils import util
+import functools
+import time
+import zlib
+from month_cache import get_month_cache
+import metrics
+
+# Heavy dependencies (aiohttp, bs4, lxml, requests, babel, pytz, dateutil, cryptography) are imported
+# where they are used so importing this module stays cheap, warm_up loads them ahead of the first request
+
+# Base URLs of Facebook, can be pointed at a stand-in server (see bench/fake_facebook.py)
+FACEBOOK_URL = os.environ.get('FACEBOOK_URL', 'https://www.facebook.com')
+FACEBOOK_MOBILE_URL = os.environ.get(
+    'FACEBOOK_MOBILE_URL', 'https://m.facebook.com')
+
+# Locales warm_up prepares parsers for, comma separated
+WARM_UP_LOCALES = os.environ.get('WARM_UP_LOCALES', 'en_US').split(',')
+
+# Reasons of a failed probe of a stored session meaning Facebook no longer accepts it (rather than Facebook failing)
+STALE_SESSION_REASONS = frozenset(
+    ['login_required', 'locale_response_invalid', 'locale_invalid'])
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.169 Safari/537.36'
+
+# Regexp extracting vanity name, tooltip content and name from birthday cards
+BIRTHDAY_STRING_REGEXP_STRING = r'class=\"_43q7\".*?href=\"https://www\.facebook\.com/(.*?)\".*?data-tooltip-content=\"(.*?)\">.*?alt=\"(.*?)\".*?/>'
+
+# Birthday async responses are parsed while they are being downloaded, in chunks of this size
+ASYNC_BIRTHDAYS_CHUNK_SIZE = 16 * 1024
+
+# Number of months scraped by default, starting from the current one
+MONTH_WINDOW = 12
+
+# Maximum number of birthday months requested from Facebook at the same time
+ASYNC_BIRTHDAYS_MAX_WORKERS = 4
+
+# Maximum number of concurrent composer query lookups when resolving vanity names
+VANITY_RESOLVE_MAX_WORKERS = 8
+
+# Maximum number of concurrent profile page scrapes (slow fallback for vanity names)
+PROFILE_PAGE_MAX_WORKERS = 2
+
+# Profile pages are scanned for the entity id while they stream in, giving up after PROFILE_PAGE_MAX_BYTES
+PROFILE_PAGE_CHUNK_SIZE = 8 * 1024
+PROFILE_PAGE_MAX_BYTES = 1024 * 1024
+# Encodings profile pages are accepted in, the ones ProfilePageScanner decompresses
+PROFILE_PAGE_ACCEPT_ENCODING = 'gzip, deflate'
+# Longest entity id match, kept between chunks
+PROFILE_PAGE_MATCH_OVERLAP = 64
+
+# Mapping of locale identifier to month/day datetime format of Facebook birthday tooltips
+LOCALE_DATE_FORMAT_MAPPING = {
+    'af_ZA': '%d-%m',
+    'am_ET': '%m/%d',
+    # 'ar_AR': '', # TODO: date format of the tooltips (Arabic numeric characters are parsed)
+    # 'as_IN': '', # TODO: date format of the tooltips (Assamese numeric characters are parsed)
+    'az_AZ': '%d.%m',
+    'be_BY': '%d.%m',
+    'bg_BG': '%d.%m',
+    'bn_IN': '%d/%m',
+    'br_FR': '%d/%m',
+    'bs_BA': '%d.%m.',
+    'ca_ES': '%d/%m',
+    # 'cb_IQ': '', # TODO: date format of the tooltips (Arabic numeric characters are parsed)
+    'co_FR': '%m-%d',
+    'cs_CZ': '%d. %m.',
+    'cx_PH': '%m-%d',
+    'cy_GB': '%d/%m',
+    'da_DK': '%d.%m',
+    'de_DE': '%d.%m.',
+    'el_GR': '%d/%m',
+    'en_GB': '%d/%m',
+    'en_UD': '%m/%d',
+    'en_US': '%m/%d',
+    'eo_EO': '%m-%d',
+    'es_ES': '%d/%m',
+    'es_LA': '%d/%m',
+    'et_EE': '%d.%m',
+    'eu_ES': '%m/%d',
+    # 'fa_IR': '', # TODO: date format of the tooltips, may be a Solar Hijri date (Persian numeric characters are parsed)
+    'ff_NG': '%d/%m',
+    'fi_FI': '%d.%m.',
+    'fo_FO': '%d.%m',
+    'fr_CA': '%m-%d',
+    'fr_FR': '%d/%m',
+    'fy_NL': '%d-%m',
+    'ga_IE': '%d/%m',
+    'gl_ES': '%d/%m',
+    'gn_PY': '%m-%d',
+    'gu_IN': '%d/%m',
+    'ha_NG': '%m/%d',
+    'he_IL': '%d.%m',
+    'hi_IN': '%d/%m',
+    'hr_HR': '%d. %m.',
+    'ht_HT': '%m-%d',
+    'hu_HU': '%m. %d.',
+    'hy_AM': '%d.%m',
+    'id_ID': '%d/%m',
+    'is_IS': '%d.%m.',
+    'it_IT': '%d/%m',
+    'ja_JP': '%m/%d',
+    'ja_KS': '%m/%d',
+    'jv_ID': '%d/%m',
+    'ka_GE': '%d.%m',
+    'kk_KZ': '%d.%m',
+    'km_KH': '%d/%m',
+    'kn_IN': '%d/%m',
+    'ko_KR': '%m. %d.',
+    'ku_TR': '%m-%d',
+    'ky_KG': '%d-%m',
+    'lo_LA': '%d/%m',
+    'lt_LT': '%m-%d',
+    'lv_LV': '%d.%m.',
+    'mg_MG': '%d/%m',
+    'mk_MK': '%d.%m',
+    'ml_IN': '%d/%m',
+    'mn_MN': '%m-&#x440; &#x441;&#x430;&#x440;/%d',
+    # 'mr_IN': '', # TODO: date format of the tooltips (Marathi numeric characters are parsed)
+    'ms_MY': '%d-%m',
+    'mt_MT': '%m-%d',
+    # 'my_MM': '', # TODO: date format of the tooltips (Myanmar numeric characters are parsed)
+    'nb_NO': '%d.%m.',
+    # 'ne_NP': '', # TODO: date format of the tooltips (Nepali numeric characters are parsed)
+    'nl_BE': '%d/%m',
+    'nl_NL': '%d-%m',
+    'nn_NO': '%d.%m.',
+    'or_IN': '%m/%d',
+    'pa_IN': '%d/%m',
+    'pl_PL': '%d.%m',
+    # 'ps_AF': '', # TODO: date format of the tooltips, may be a Solar Hijri date (Afghani numeric characters are parsed)
+    'pt_BR': '%d/%m',
+    'pt_PT': '%d/%m',
+    'ro_RO': '%d.%m',
+    'ru_RU': '%d.%m',
+    'rw_RW': '%m-%d',
+    'sc_IT': '%m-%d',
+    'si_LK': '%m-%d',
+    'sk_SK': '%d. %m.',
+    'sl_SI': '%d. %m.',
+    'sn_ZW': '%m-%d',
+    'so_SO': '%m/%d',
+    'sq_AL': '%d.%m',
+    'sr_RS': '%d.%m.',
+    'sv_SE': '%d/%m',
+    'sw_KE': '%d/%m',
+    'sy_SY': '%m-%d',
+    'sz_PL': '%m-%d',
+    'ta_IN': '%d/%m',
+    'te_IN': '%d/%m',
+    'tg_TJ': '%m-%d',
+    'th_TH': '%d/%m',
+    'tl_PH': '%m/%d',
+    'tr_TR': '%d/%m',
+    'tt_RU': '%d.%m',
+    'tz_MA': '%m/%d',
+    'uk_UA': '%d.%m',
+    'ur_PK': '%d/%m',
+    'uz_UZ': '%d/%m',
+    'vi_VN': '%d/%m',
+    'zh_CN': '%m/%d',
+    'zh_HK': '%d/%m',
+    'zh_TW': '%m/%d',
+    'zz_TR': '%m-%d'
+}
 
 # Classes
 
 
 class Birthday:
-    def __init__(self, uid, name, day, month):
+    def __init__(self, uid, name, day, month, vanity_name=None):
         # Unique identififer for person (required for ics events)
+        # None until resolved from vanity_name
         self.uid = uid
         self.name = name
         self.day = day
         self.month = month
+        # Custom profile name for people whose uid still has to be resolved
+        self.vanity_name = vanity_name
 
     def __str__(self):
         return f'{self.name} ({self.day}/{self.month})'
@@ -57,201 +214,270 @@ class Birthday:
     def __unicode__(self):
         return u'{self.name} ({self.day}/{self.month})'
 
-# Entry point
 
+class ScrapeError(SystemError):
+    """ Scrape failure with a short machine readable reason (used in metrics and error responses) """
 
-def get_birthdays(email, password):
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
 
-    browser = mechanicalsoup.StatefulBrowser()
-    init_browser(browser)
 
-    # Attempt login
-    facebook_authenticate(browser, email, password)
+class ScrapeContext:
+    """ State of a single logged in Facebook session.
+        The async token and locale are memoized for the lifetime of the session (async_bdays.AsyncScrapeContext
+        fetches them) so they are never shared between users scraping different accounts. """
 
-    # Get birthday objects for all friends via async endpoint
-    birthdays = get_async_birthdays(browser)
+    def __init__(self, progress=None, account=None, checkpoint=None):
+        # Account key (see result_cache.account_key) of the logged in user, if known
+        self.account = account
+        # ScrapeCheckpoint of a partial scrape, failures are recorded in it instead of raised
+        self.checkpoint = checkpoint
+        # Optional callable receiving a dict for every completed scrape phase
+        self.progress = progress
+        # Phase timings of the request this scrape belongs to, tasks of the scrape report to them explicitly
+        self.timings = metrics.current_timings()
+        self._async_token = None
+        self._locale = None
 
-    if len(birthdays) == 0:
-        raise SystemError
+    @property
+    def async_token(self):
+        return self._async_token
 
-    c = populate_birthdays_calendar(birthdays)
+    @property
+    def locale(self):
+        return self._locale
 
-    # Remove blank lines
-    return ''.join([line.rstrip('\n') for line in c])
+    def restore(self, async_token, locale=None):
+        """ Seed the memoized values from a previously stored session """
+        self._async_token = async_token
+        self._locale = locale
 
+    def report_progress(self, phase, **details):
+        if self.progress:
+            self.progress(dict(phase=phase, **details))
 
-def init_browser(browser):
-    """ Initialize browser as needed """
-    browser.set_user_agent(
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.169 Safari/537.36')
+    @property
+    def locale_parser(self):
+        """ Birthday tooltip parser of the users locale """
+        return get_locale_date_parser(self.locale)
 
+# Entry point
 
-def facebook_authenticate(browser, email, password):
-    """ Authenticate with Facebook setting up session for further requests """
 
-    FACEBOOK_LOGIN_URL = 'http://www.facebook.com/login.php'
-    FACEBOOK_DATR_TOKEN_REGEXP = r'\"_js_datr\",\"(.*?)\"'
-    regexp = re.compile(FACEBOOK_DATR_TOKEN_REGEXP, re.MULTILINE)
+def get_birthdays(email, password, max_workers=ASYNC_BIRTHDAYS_MAX_WORKERS, progress=None,
+                  first_month=0, months=MONTH_WINDOW, checkpoint=None, output_format='ics'):
+    """ Scrape birthdays into an ics calendar (or another format of formats.py) on the asyncio engine
+        (see async_bdays.py), blocking until it is done.
+        The other arguments are the ones of async_bdays.scrape_birthdays_async. """
 
-    # Add 'datr' cookie to session for countries adhering to GDPR compliance
-    login_page = browser.get(FACEBOOK_LOGIN_URL)
+    import async_bdays
 
-    if login_page.status_code != 200:
-        raise SystemError
+    return async_bdays.run(async_bdays.get_birthdays_async(
+        email, password, max_workers, progress, first_month, months, checkpoint, output_format))
 
-    matches = regexp.search(login_page.text)
 
-    if not matches or len(matches.groups()) != 1:
-        raise SystemError
+class MonthWindow:
+    """ Months of a scrape, taken from the month cache and checkpoint where possible.
+        Only the stale_epoch_timestamps months have to be fetched from Facebook. """
 
-    _js_datr = matches[1]
+    def __init__(self, account, first_month=0, months=MONTH_WINDOW, checkpoint=None, month_cache=None):
+        self.account = account
+        self.first_month = first_month
+        self.checkpoint = checkpoint
+        self.month_cache = month_cache or get_month_cache()
+        self.epoch_timestamps = get_month_epoch_timestamps(first_month, months)
+        self.birthdays_by_month = self.month_cache.get_many(
+            account, self.epoch_timestamps)
 
-    datr_cookie = requests.cookies.create_cookie(
-        domain='.facebook.com', name='datr', value=_js_datr)
-    _js_datr_cookie = requests.cookies.create_cookie(
-        domain='.facebook.com', name='_js_datr', value=_js_datr)
-    browser.get_cookiejar().set_cookie(datr_cookie)
-    browser.get_cookiejar().set_cookie(_js_datr_cookie)
+        if checkpoint is not None:
+            checkpoint.start_attempt()
+            for epoch_timestamp, birthdays_for_month in checkpoint.months.items():
+                self.birthdays_by_month.setdefault(
+                    epoch_timestamp, birthdays_for_month)
 
-    # Perform main login now
-    login_page = browser.get(FACEBOOK_LOGIN_URL)
+        self.stale_epoch_timestamps = [
+            epoch_timestamp for epoch_timestamp in self.epoch_timestamps if epoch_timestamp not in self.birthdays_by_month]
 
-    if login_page.status_code != 200:
-        raise SystemError
+    def add_fetched_months(self, fetched_birthdays_by_month):
+        """ Add the birthdays fetched for each of the stale months (None for a failed month) """
 
-    login_form = login_page.soup.find('form', {'id': 'login_form'})
-    login_form.find('input', {'id': 'email'})['value'] = email
-    login_form.find('input', {'id': 'pass'})['value'] = password
-    login_response = browser.submit(login_form, login_page.url)
+        failed_months = set()
+        if self.checkpoint is not None:
+            failed_months = self.checkpoint.failed_months()
 
-    if login_response.status_code != 200:
-        raise SystemError
+        for epoch_timestamp, birthdays_for_month in zip(self.stale_epoch_timestamps, fetched_birthdays_by_month):
+            if birthdays_for_month is None:
+                continue
 
-    # Check to see if login failed
-    if login_response.soup.find('link', {'rel': 'canonical', 'href': 'https://www.facebook.com/login/'}):
-        raise SystemError
+            self.birthdays_by_month[epoch_timestamp] = birthdays_for_month
 
-    # Check to see if we hit Facebook security checkpoint
-    if login_response.soup.find('button', {'id': 'checkpointSubmitButton'}):
-        raise SystemError
+            # Only complete months are worth keeping
+            if epoch_timestamp in failed_months:
+                continue
 
+            self.month_cache.set(self.account, epoch_timestamp,
+                                 self.first_month + self.epoch_timestamps.index(epoch_timestamp), birthdays_for_month)
+            if self.checkpoint is not None:
+                self.checkpoint.complete_month(
+                    epoch_timestamp, birthdays_for_month)
 
-__cached_async_token = None
+    def birthdays(self):
+        """ Returns birthdays of all months in month order, empty if no friend has a birthday in the window """
 
+        if not any(epoch_timestamp in self.birthdays_by_month for epoch_timestamp in self.epoch_timestamps):
+            # Not a single month could be fetched, nothing worth a partial calendar, report the first failure
+            raise ScrapeError(self.checkpoint.failures[0]['reason']
+                              if self.checkpoint is not None and self.checkpoint.failures else 'no_months')
 
-def get_async_token(browser):
-    """ Get async authorization token (CSRF protection token) that must be included in all async requests """
+        return [birthday for epoch_timestamp in self.epoch_timestamps
+                for birthday in self.birthdays_by_month.get(epoch_timestamp, [])]
 
-    global __cached_async_token
 
-    if __cached_async_token:
-        return __cached_async_token
+def warm_up(locales=WARM_UP_LOCALES):
+    """ Import the lazily loaded dependencies and precompute regexps, locale tables and Babel data for locales.
+        Meant to run once in the gunicorn master (--preload) so forked workers share the result copy-on-write,
+        so it must not open connections or database handles that would end up shared between workers. """
 
-    # async token is present on this page
-    FACEBOOK_BIRTHDAY_EVENT_PAGE_URL = 'https://www.facebook.com/events/birthdays/'
-    FACEBOOK_ASYNC_TOKEN_REGEXP_STRING = r'{\"token\":\".*?\",\"async_get_token\":\"(.*?)\"}'
-    regexp = re.compile(FACEBOOK_ASYNC_TOKEN_REGEXP_STRING, re.MULTILINE)
+    import bs4
+    import async_bdays  # noqa: F401
+    import session_store  # noqa: F401
 
-    birthday_event_page = browser.get(FACEBOOK_BIRTHDAY_EVENT_PAGE_URL)
+    # lxml tree builder used to parse the login pages
+    bs4.BeautifulSoup('<html></html>', 'lxml')
 
-    if birthday_event_page.status_code != 200:
-        raise SystemError
+    # Timezone database and dateutil
+    get_month_epoch_timestamps()
 
-    matches = regexp.search(birthday_event_page.text)
+    context = ScrapeContext()
 
-    if not matches or len(matches.groups()) != 1:
-        raise SystemError
+    for user_locale in locales:
+        try:
+            locale_parser = get_locale_date_parser(user_locale)
+            # Loads the Babel locale data
+            locale_parser.get_day_name_offset_dict(date.today())
+        except SystemError:
+            continue
+
+        # Compiles the birthday card regexp and exercises the streamed parse path with a card dated in the locale
+        context.restore(None, user_locale)
+        card_date = LOCALE_DATE_FORMAT_MAPPING[user_locale].replace('%d', '01').replace('%m', '01')
+        card_html = ('<li class="_43q7"><a href="https://www.facebook.com/profile.php?id=1" '
+                     f'data-tooltip-content="Warm Up ({card_date})"><img alt="Warm Up" /></a></li>')
+        extractor = BirthdayCardExtractor()
+        for card in extractor.feed(('for (;;);' + json.dumps(
+                {'domops': [[None, None, None, {'__html': card_html}]]})).encode()) + extractor.finish():
+            append_birthday_card(context, [], None, card)
 
-    __cached_async_token = matches[1]
+
+def parse_datr_token(text):
+    """ Returns the datr token of the login page text """
+
+    FACEBOOK_DATR_TOKEN_REGEXP = r'\"_js_datr\",\"(.*?)\"'
+    regexp = re.compile(FACEBOOK_DATR_TOKEN_REGEXP, re.MULTILINE)
+
+    matches = regexp.search(text)
+
+    if not matches or len(matches.groups()) != 1:
+        raise ScrapeError('datr_token_missing')
 
     return matches[1]
 
 
-__locale = None
+def check_login_response(soup):
+    """ Raise if the (BeautifulSoup parsed) response of the login form shows the login failed """
 
+    # Check to see if login failed
+    if soup.find('link', {'rel': 'canonical', 'href': 'https://www.facebook.com/login/'}):
+        raise ScrapeError('login_failed')
 
-def get_facebook_locale(browser):
-    """ Returns users Facebook locale """
+    # Check to see if we hit Facebook security checkpoint
+    if soup.find('button', {'id': 'checkpointSubmitButton'}):
+        raise ScrapeError('security_checkpoint')
 
-    global __locale
 
-    if __locale:
-        return __locale
+def parse_async_token(text):
+    """ Returns the async token of the birthday event page text """
+
+    FACEBOOK_ASYNC_TOKEN_REGEXP_STRING = r'{\"token\":\".*?\",\"async_get_token\":\"(.*?)\"}'
+    regexp = re.compile(FACEBOOK_ASYNC_TOKEN_REGEXP_STRING, re.MULTILINE)
+
+    matches = regexp.search(text)
+
+    if not matches or len(matches.groups()) != 1:
+        raise ScrapeError('async_token_missing')
+
+    return matches[1]
 
-    FACEBOOK_LOCALE_ENDPOINT = 'https://www.facebook.com/ajax/settings/language/account.php?'
-    FACEBOOK_LOCALE_REGEXP_STRING = r'[a-z]{2}_[A-Z]{2}'
-    regexp = re.compile(FACEBOOK_LOCALE_REGEXP_STRING, re.MULTILINE)
 
-    # Not all fields are required for response to be given, required fields are fb_dtsg_ag and __a
-    query_params = {'fb_dtsg_ag': get_async_token(browser),
-                    '__a': '1'}
+def is_login_url(url):
+    """ Returns whether url is the login page, where Facebook redirects requests of a session it doesn't accept """
 
-    response = browser.get(FACEBOOK_LOCALE_ENDPOINT +
-                           urllib.parse.urlencode(query_params))
+    return urllib.parse.urlsplit(str(url)).path.startswith('/login')
 
-    if response.status_code != 200:
-        raise SystemError
+
+def parse_facebook_locale(text):
+    """ Returns the locale of the language settings response text """
+
+    FACEBOOK_LOCALE_REGEXP_STRING = r'[a-z]{2}_[A-Z]{2}'
+    regexp = re.compile(FACEBOOK_LOCALE_REGEXP_STRING, re.MULTILINE)
 
     # Parse json response
     try:
-        json_response = json.loads(strip_ajax_response_prefix(response.text))
+        json_response = json.loads(strip_ajax_response_prefix(text))
         current_locale = json_response['jsmods']['require'][0][3][1]['currentLocale']
     except json.decoder.JSONDecodeError as e:
-        raise SystemError
+        raise ScrapeError('locale_response_invalid')
     except KeyError as e:
-        raise SystemError
+        raise ScrapeError('locale_response_invalid')
 
     # Validate locale
     if not regexp.match(current_locale):
-        raise SystemError
-
-    __locale = current_locale
+        raise ScrapeError('locale_invalid')
 
-    return __locale
+    return current_locale
 
 
-def get_async_birthdays(browser):
-    """ Returns list of birthday objects by querying the Facebook birthday async page """
+def failure_reason(error):
+    """ Reason recorded in checkpoints for an exception of a partial scrape """
 
-    FACEBOOK_BIRTHDAY_ASYNC_ENDPOINT = 'https://www.facebook.com/async/birthdays/?'
+    return getattr(error, 'reason', type(error).__name__)
 
-    birthdays = []
 
-    next_12_months_epoch_timestamps = get_next_12_month_epoch_timestamps()
+def drop_unresolved_birthdays(checkpoint, epoch_timestamps, birthdays_by_month):
+    """ Leave the birthdays whose vanity name couldn't be resolved out of their month, recording them in checkpoint """
 
-    for epoch_timestamp in next_12_months_epoch_timestamps:
-
-        # Not all fields are required for response to be given, required fields are date, fb_dtsg_ag and __a
-        query_params = {'date': epoch_timestamp,
-                        'fb_dtsg_ag': get_async_token(browser),
-                        '__a': '1'}
+    for index, birthdays_for_month in enumerate(birthdays_by_month):
+        if birthdays_for_month is None:
+            continue
 
-        response = browser.get(
-            FACEBOOK_BIRTHDAY_ASYNC_ENDPOINT + urllib.parse.urlencode(query_params))
+        for birthday in birthdays_for_month:
+            if not birthday.uid:
+                checkpoint.add_failure('vanity', 'vanity_name_unresolved',
+                                       epoch_timestamps[index], birthday.vanity_name)
 
-        if response.status_code != 200:
-            raise SystemError
+        birthdays_by_month[index] = [
+            birthday for birthday in birthdays_for_month if birthday.uid]
 
-        birthdays_for_month = parse_birthday_async_output(
-            browser, response.text)
-        birthdays.extend(birthdays_for_month)
 
-    return birthdays
+def get_month_epoch_timestamps(first_month=0, months=MONTH_WINDOW):
+    """ Returns array of epoch timestamps corresponding to the 1st day of months months starting first_month months from the current month.
+        The window has to stay within the next 12 months as events are placed in this or next year by month. """
 
+    import pytz
+    from dateutil.relativedelta import relativedelta
 
-def get_next_12_month_epoch_timestamps():
-    """ Returns array of epoch timestamps corresponding to the 1st day of the next 12 months starting from the current month.
-        For example, if the current date is 2000-05-20, will return epoch for 2000-05-01, 2000-06-01, 2000-07-01 etc for 12 months """
+    check_month_window(first_month, months)
 
     epoch_timestamps = []
 
     # Facebook timezone seems to use Pacific Standard Time locally for these epochs
     # So we have to convert our 00:00:01 datetime on 1st of month from Pacific to UTC before getting our epoch timestamps
     pdt = pytz.timezone('America/Los_Angeles')
-    cur_date = datetime.now()
+    cur_date = datetime.now() + relativedelta(months=first_month)
 
-    # Loop for next 12 months
-    for _ in range(12):
+    # Loop for the requested months
+    for _ in range(months):
         # Reset day to 1 and time to 00:00:01
         cur_date = cur_date.replace(
             day=1, hour=0, minute=0, second=0, microsecond=0)
@@ -266,212 +492,269 @@ def get_next_12_month_epoch_timestamps():
     return epoch_timestamps
 
 
-def parse_birthday_async_output(browser, text):
-    """ Parsed Birthday Async output text and returns list of Birthday objects """
-    BIRTHDAY_STRING_REGEXP_STRING = r'class=\"_43q7\".*?href=\"https://www\.facebook\.com/(.*?)\".*?data-tooltip-content=\"(.*?)\">.*?alt=\"(.*?)\".*?/>'
-    regexp = re.compile(BIRTHDAY_STRING_REGEXP_STRING, re.MULTILINE)
+def check_month_window(first_month, months):
+    """ Raise ValueError unless the month window stays within the next 12 months """
 
-    birthdays = []
+    if first_month < 0 or months < 1 or first_month + months > 12:
+        raise ValueError(
+            f'Month window {first_month}+{months} is not within the next 12 months')
+
+
+def append_birthday(context, birthdays, card_failures, vanity_name, tooltip_content, name):
+    """ Append the Birthday object of a card to birthdays.
+        Cards that can't be parsed raise, unless card_failures is a list collecting their (reason, name) """
 
-    # Fetch birthday card html payload from json response
     try:
-        json_response = json.loads(strip_ajax_response_prefix(text))
-        birthday_card_html = json_response['domops'][0][3]['__html']
-    except json.decoder.JSONDecodeError as e:
-        raise SystemError
-    except KeyError as e:
-        raise SystemError
+        birthdays.append(create_birthday(
+            context, vanity_name, tooltip_content, name))
+    except ScrapeError as e:
+        if card_failures is None:
+            raise
+        card_failures.append((e.reason, html.unescape(name)))
+
+
+def create_birthday(context, vanity_name, tooltip_content, name):
+    """ Create Birthday object from the fields of a birthday card """
+
+    # Parse tooltip content into day/month
+    day, month = parse_birthday_day_month(
+        tooltip_content, name, context)
+
+    # Check to see if user has no custom vanity name in which case we'll just take the id directly
+    if vanity_name.startswith('profile.php?id='):
+        return Birthday(vanity_name[15:], html.unescape(name), day, month)
+
+    return Birthday(None, html.unescape(name), day, month, vanity_name)
+
+
+def append_birthday_card(context, birthdays, card_failures, card_html):
+    """ Append the Birthday object of the HTML of a single card (see BirthdayCardExtractor) to birthdays """
+
+    # Each card is matched on its own so the regexp can't backtrack across the whole month
+    matches = re.match(BIRTHDAY_STRING_REGEXP_STRING, card_html, re.MULTILINE)
+    if matches:
+        append_birthday(context, birthdays, card_failures, *matches.groups())
+
+
+class BirthdayCardExtractor:
+    """ Incrementally splits a raw (JSON encoded) birthday async response into the HTML of its birthday cards """
+
+    # Start of a birthday card as it appears inside the JSON string
+    CARD_MARKER = 'class=\\"_43q7\\"'
+
+    # Key of the card HTML payload, its absence means the response is not a birthday async response
+    HTML_KEY = '"__html"'
+
+    # Longest prefix that is still inside the JSON string (up to the first unescaped quote)
+    JSON_STRING_CONTENT = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._in_card = False
+        # Offset in the buffer the JSON string was scanned up to, scanning resumes there with the next chunk
+        self._scanned = 0
+        # Set at the end of the JSON string holding the cards, the rest of the response is ignored
+        self._string_ended = False
+        self.saw_card_html = False
+
+    def feed(self, chunk):
+        """ Add raw bytes of the response, returns list of HTML of every card completed by them """
+
+        if self._string_ended:
+            return []
+
+        self._buffer += self._decoder.decode(chunk)
 
-    user_locale = get_facebook_locale(browser)
+        if not self.saw_card_html and self.HTML_KEY in self._buffer:
+            self.saw_card_html = True
 
-    for vanity_name, tooltip_content, name in regexp.findall(birthday_card_html):
-        # Check to see if user has no custom vanity name in which case we'll just take the id directly
-        if vanity_name.startswith('profile.php?id='):
-            uid = vanity_name[15:]
+        if not self._in_card:
+            first_card = self._buffer.find(self.CARD_MARKER)
+
+            if first_card == -1:
+                # Keep just enough to find a marker or key split between chunks
+                self._buffer = self._buffer[-max(len(self.CARD_MARKER), len(self.HTML_KEY)):]
+                return []
+
+            self._buffer = self._buffer[first_card:]
+            self._in_card = True
+            self._scanned = 0
+
+        # Cards are only looked for up to the end of the JSON string (its first unescaped quote)
+        string_end = self.JSON_STRING_CONTENT.match(
+            self._buffer, self._scanned).end()
+        self._string_ended = self._buffer.startswith('"', string_end)
+
+        cards = []
+
+        # Look for the start of the next card in the newly scanned part, skipping the start of the current one
+        start = 0
+        next_card = self._buffer.find(self.CARD_MARKER, max(
+            len(self.CARD_MARKER), self._scanned - len(self.CARD_MARKER) + 1), string_end)
+
+        while next_card != -1:
+            cards.append(self._decode(self._buffer[start:next_card]))
+
+            start = next_card
+            next_card = self._buffer.find(
+                self.CARD_MARKER, start + len(self.CARD_MARKER), string_end)
+
+        if self._string_ended:
+            cards.append(self._decode(self._buffer[start:string_end]))
+            self._buffer = ''
+            self._in_card = False
         else:
-            uid = get_entity_id_from_vanity_name(browser, vanity_name)
+            self._buffer = self._buffer[start:]
+            self._scanned = string_end - start
 
-        # Parse tooltip content into day/month
-        day, month = parse_birthday_day_month(
-            tooltip_content, name, user_locale)
+        return cards
 
-        birthdays.append(Birthday(uid, html.unescape(name), day, month))
+    def finish(self):
+        """ Returns list with the HTML of the last card (if any) once the whole response was fed """
 
-    return birthdays
+        self._buffer += self._decoder.decode(b'', final=True)
 
+        if not self._in_card:
+            return []
 
-def parse_birthday_day_month(tooltip_content, name, user_locale):
+        self._in_card = False
+        return [self._decode(self._buffer)]
+
+    @classmethod
+    def _decode(cls, fragment):
+        """ Decode a fragment of the JSON string holding the cards, cutting it at the end of the string """
+
+        fragment = cls.JSON_STRING_CONTENT.match(fragment).group()
+
+        try:
+            return json.loads(f'"{fragment}"')
+        except json.decoder.JSONDecodeError:
+            raise ScrapeError('async_birthdays_response_invalid')
+
+
+def parse_birthday_day_month(tooltip_content, name, context):
     """ Convert the Facebook birthday tooltip content to a day and month number. Facebook will use a tooltip format based on the users Facebook language (locale).
         The date will be in some date format which reveals the birthday day and birthday month.
         This is done for all birthdays expect those in the following week relative to the current date.
         Those will instead show day names such as 'Monday', 'Tuesday' etc for the next 7 days. """
 
-    birthday_date_str = tooltip_content
+    return context.locale_parser.parse(tooltip_content, name)
+
+
+class LocaleDateParser:
+    """ Parses birthday tooltips of one locale. Built once per locale, see get_locale_date_parser. """
 
-    # List of strings that will be stripped away from tooltip_content
-    # The goal here is to remove all other characters except the birthday day, birthday month and day/month seperator symbol
-    strip_list = [
-        name,  # Full name of user which will appear somewhere in the string
+    # Characters stripped from the tooltip so that only the birthday day, birthday month and day/month seperator symbol remain
+    STRIP_TRANSLATION = str.maketrans('', '', ''.join([
         '(',  # Regular left bracket
         ')',  # Regular right bracket
-        '&#x200f;',  # Remove right-to-left mark (RLM)
-        '&#x200e;',  # Remove left-to-right mark (LRM)
-        '&#x55d;'  # Backtick character name postfix in Armenian
-    ]
-
-    for string in strip_list:
-        birthday_date_str = birthday_date_str.replace(string, '')
-
-    birthday_date_str = birthday_date_str.strip()
-
-    # Dict with mapping of locale identifier to month/day datetime format
-    locale_date_format_mapping = {
-        'af_ZA': '%d-%m',
-        'am_ET': '%m/%d',
-        # 'ar_AR': '', # TODO: parse Arabic numeric characters
-        # 'as_IN': '', # TODO: parse Assamese numeric characters
-        'az_AZ': '%d.%m',
-        'be_BY': '%d.%m',
-        'bg_BG': '%d.%m',
-        'bn_IN': '%d/%m',
-        'br_FR': '%d/%m',
-        'bs_BA': '%d.%m.',
-        'ca_ES': '%d/%m',
-        # 'cb_IQ': '', # TODO: parse Arabic numeric characters
-        'co_FR': '%m-%d',
-        'cs_CZ': '%d. %m.',
-        'cx_PH': '%m-%d',
-        'cy_GB': '%d/%m',
-        'da_DK': '%d.%m',
-        'de_DE': '%d.%m.',
-        'el_GR': '%d/%m',
-        'en_GB': '%d/%m',
-        'en_UD': '%m/%d',
-        'en_US': '%m/%d',
-        'eo_EO': '%m-%d',
-        'es_ES': '%d/%m',
-        'es_LA': '%d/%m',
-        'et_EE': '%d.%m',
-        'eu_ES': '%m/%d',
-        # 'fa_IR': '', # TODO: parse Persian numeric characters
-        'ff_NG': '%d/%m',
-        'fi_FI': '%d.%m.',
-        'fo_FO': '%d.%m',
-        'fr_CA': '%m-%d',
-        'fr_FR': '%d/%m',
-        'fy_NL': '%d-%m',
-        'ga_IE': '%d/%m',
-        'gl_ES': '%d/%m',
-        'gn_PY': '%m-%d',
-        'gu_IN': '%d/%m',
-        'ha_NG': '%m/%d',
-        'he_IL': '%d.%m',
-        'hi_IN': '%d/%m',
-        'hr_HR': '%d. %m.',
-        'ht_HT': '%m-%d',
-        'hu_HU': '%m. %d.',
-        'hy_AM': '%d.%m',
-        'id_ID': '%d/%m',
-        'is_IS': '%d.%m.',
-        'it_IT': '%d/%m',
-        'ja_JP': '%m/%d',
-        'ja_KS': '%m/%d',
-        'jv_ID': '%d/%m',
-        'ka_GE': '%d.%m',
-        'kk_KZ': '%d.%m',
-        'km_KH': '%d/%m',
-        'kn_IN': '%d/%m',
-        'ko_KR': '%m. %d.',
-        'ku_TR': '%m-%d',
-        'ky_KG': '%d-%m',
-        'lo_LA': '%d/%m',
-        'lt_LT': '%m-%d',
-        'lv_LV': '%d.%m.',
-        'mg_MG': '%d/%m',
-        'mk_MK': '%d.%m',
-        'ml_IN': '%d/%m',
-        'mn_MN': '%m-&#x440; &#x441;&#x430;&#x440;/%d',
-        # 'mr_IN': '', # TODO: parse Marathi numeric characters
-        'ms_MY': '%d-%m',
-        'mt_MT': '%m-%d',
-        # 'my_MM': '', # TODO: parse Myanmar numeric characters
-        'nb_NO': '%d.%m.',
-        # 'ne_NP': '', # TODO: parse Nepali numeric characters
-        'nl_BE': '%d/%m',
-        'nl_NL': '%d-%m',
-        'nn_NO': '%d.%m.',
-        'or_IN': '%m/%d',
-        'pa_IN': '%d/%m',
-        'pl_PL': '%d.%m',
-        # 'ps_AF': '', # TODO: parse Afghani numeric characters
-        'pt_BR': '%d/%m',
-        'pt_PT': '%d/%m',
-        'ro_RO': '%d.%m',
-        'ru_RU': '%d.%m',
-        'rw_RW': '%m-%d',
-        'sc_IT': '%m-%d',
-        'si_LK': '%m-%d',
-        'sk_SK': '%d. %m.',
-        'sl_SI': '%d. %m.',
-        'sn_ZW': '%m-%d',
-        'so_SO': '%m/%d',
-        'sq_AL': '%d.%m',
-        'sr_RS': '%d.%m.',
-        'sv_SE': '%d/%m',
-        'sw_KE': '%d/%m',
-        'sy_SY': '%m-%d',
-        'sz_PL': '%m-%d',
-        'ta_IN': '%d/%m',
-        'te_IN': '%d/%m',
-        'tg_TJ': '%m-%d',
-        'th_TH': '%d/%m',
-        'tl_PH': '%m/%d',
-        'tr_TR': '%d/%m',
-        'tt_RU': '%d.%m',
-        'tz_MA': '%m/%d',
-        'uk_UA': '%d.%m',
-        'ur_PK': '%d/%m',
-        'uz_UZ': '%d/%m',
-        'vi_VN': '%d/%m',
-        'zh_CN': '%m/%d',
-        'zh_HK': '%d/%m',
-        'zh_TW': '%m/%d',
-        'zz_TR': '%m-%d'
+        '\u200f',  # Right-to-left mark (RLM)
+        '\u200e',  # Left-to-right mark (LRM)
+        '\u055d'  # Backtick character name postfix in Armenian
+    ]))
+
+    # Same values as accepted by strptime's %d and %m directives
+    # \d also matches non-ASCII digits (Arabic, Persian, Devanagari etc) which int() decodes
+    DATE_FORMAT_DIRECTIVE_REGEXP_STRINGS = {
+        '%d': r'(?P<day>\d{1,2})',
+        '%m': r'(?P<month>\d{1,2})'
     }
 
-    # Ensure a supported locale is being used
-    if user_locale not in locale_date_format_mapping:
-        raise SystemError
+    def __init__(self, user_locale):
+        # Ensure a supported locale is being used
+        if user_locale not in LOCALE_DATE_FORMAT_MAPPING:
+            raise ScrapeError('unsupported_locale')
+
+        self.locale = user_locale
+        self.date_regexp = self.compile_date_format(
+            html.unescape(LOCALE_DATE_FORMAT_MAPPING[user_locale]))
+
+        # Day name offsets are only valid for the date they were computed on
+        self._day_name_offsets = (None, None)
+
+    @classmethod
+    def compile_date_format(cls, date_format):
+        """ Compile a strptime style day/month format into a regexp with day and month groups """
+
+        regexp_string = ''
+        for token in re.split(r'(%[dm]|\s+)', date_format):
+            if token in cls.DATE_FORMAT_DIRECTIVE_REGEXP_STRINGS:
+                regexp_string += cls.DATE_FORMAT_DIRECTIVE_REGEXP_STRINGS[token]
+            elif token.isspace():
+                regexp_string += r'\s+'
+            else:
+                regexp_string += re.escape(token)
+
+        return re.compile(regexp_string, re.IGNORECASE)
+
+    def parse(self, tooltip_content, name, today=None):
+        """ Returns (day, month) tuple of the birthday in the tooltip """
+
+        birthday_date_str = html.unescape(tooltip_content)
+
+        # Full name of user will appear somewhere in the string
+        birthday_date_str = birthday_date_str.replace(html.unescape(name), '')
+        birthday_date_str = birthday_date_str.translate(
+            self.STRIP_TRANSLATION).strip()
+
+        if today is None:
+            today = date.today()
 
-    try:
         # Try to parse the date using appropriate format based on locale
-        parsed_date = datetime.strptime(
-            birthday_date_str, locale_date_format_mapping[user_locale])
-        return (parsed_date.day, parsed_date.month)
-    except ValueError:
-        # Otherwise, have to convert day names to a day and month
-        offset_dict = get_day_name_offset_dict(user_locale)
-        cur_date = datetime.now()
+        matches = self.date_regexp.fullmatch(birthday_date_str)
+        if matches:
+            day, month = int(matches['day']), int(matches['month'])
 
-        # Use beautiful soup to parse special html codes properly before matching with our dict
-        day_name = BeautifulSoup(birthday_date_str, 'lxml').get_text().lower()
+            # Validate against a leap year so the 29th of February is accepted
+            if 1 <= month <= 12 and 1 <= day <= monthrange(2000, month)[1]:
+                return (day, month)
+
+        # Otherwise, have to convert day names to a day and month
+        offset_dict = self.get_day_name_offset_dict(today)
+        day_name = birthday_date_str.lower()
 
         if day_name in offset_dict:
-            cur_date = cur_date + relativedelta(days=offset_dict[day_name])
-            return (cur_date.day, cur_date.month)
+            birthday_date = today + timedelta(days=offset_dict[day_name])
+            return (birthday_date.day, birthday_date.month)
+
+        raise ScrapeError('unparseable_tooltip')
+
+    def get_day_name_offset_dict(self, today):
+        """ Returns day name offset dict for today, computed once per calendar date """
 
-    raise SystemError
+        offsets_date, offset_dict = self._day_name_offsets
 
+        if offsets_date != today:
+            offset_dict = get_day_name_offset_dict(self.locale, today)
+            self._day_name_offsets = (today, offset_dict)
 
-def get_day_name_offset_dict(user_locale):
+        return offset_dict
+
+
+@functools.lru_cache(maxsize=None)
+def get_locale_date_parser(user_locale):
+    """ Returns the LocaleDateParser of user_locale shared by all sessions of this process """
+
+    return LocaleDateParser(user_locale)
+
+
+def get_day_name_offset_dict(user_locale, today=None):
     """ The day name to offset dict maps a day name to a numerical day offset which can be used to add days to the current date.
         Day names will match the provided user locale and will be in lowercase.
     """
 
+    from babel import Locale
+    from babel.core import UnknownLocaleError
+    from babel.dates import format_date
+
     offset_dict = {}
 
+    if today is None:
+        today = date.today()
+
     # Todays birthdays will be shown normally (as a date) so start from tomorrow
-    start_date = datetime.now() + relativedelta(days=1)
+    start_date = today + timedelta(days=1)
 
     # Method 1: Babel
     try:
@@ -482,11 +765,11 @@ def get_day_name_offset_dict(user_locale):
         for i in range(1, 8):
             offset_dict[format_date(
                 cur_date, 'EEEE', locale=babel_locale).lower()] = i
-            cur_date = cur_date + relativedelta(days=1)
+            cur_date = cur_date + timedelta(days=1)
 
         return offset_dict
     except UnknownLocaleError as e:
-        raise SystemError
+        raise ScrapeError('unknown_locale')
 
         # Method 2: System locale
     cur_date = start_date
@@ -514,21 +797,19 @@ def get_day_name_offset_dict(user_locale):
         # Iterate through the following 7 days
         for i in range(1, 8):
             offset_dict[cur_date.strftime('%A').lower()] = i
-            cur_date = cur_date + relativedelta(days=1)
+            cur_date = cur_date + timedelta(days=1)
 
         return offset_dict
     else:
 
         # Failure
-        raise SystemError
+        raise ScrapeError('unknown_locale')
 
 
-def get_entity_id_from_vanity_name(browser, vanity_name):
-    """ Given a vanity name (user/page custom name), try to get the unique identifier entity_id """
+def find_composer_query_entity_id(composer_query_entries, vanity_name):
+    """ Returns the uid of the composer query entry of vanity_name or None """
 
-    # Method 1: Composer Query async
     # Loop through entries to see if a valid match is found where alias matches provided vanity name
-    composer_query_entries = get_composer_query_entries(browser, vanity_name)
     for entry in composer_query_entries:
         # Skip other render types like commerce pages etc
         if entry['vertical_type'] != 'USER' and entry['render_type'] not in ['friend', 'non_friend']:
@@ -538,34 +819,15 @@ def get_entity_id_from_vanity_name(browser, vanity_name):
             # Match found!
             return entry['uid']
 
-    # Method 2: Scrape users profile page for entity id (significantly slower)
-    entity_id = get_entity_id_from_profile_page(browser, vanity_name)
-    if entity_id:
-        return entity_id
+    return None
 
-    # Failure
-    raise SystemError
 
-
-def get_composer_query_entries(browser, value):
-    """ Get list of entries from the composer query endpoint """
-
-    COMPOSER_QUERY_ASYNC_ENDPOINT = "https://www.facebook.com/ajax/mercury/composer_query.php?"
-
-    # Not all fields are required for response to be given, required fields are value, fb_dtsg_ag and __a
-    query_params = {'value': value,
-                    'fb_dtsg_ag': get_async_token(browser),
-                    '__a': '1'}
-
-    response = browser.get(COMPOSER_QUERY_ASYNC_ENDPOINT +
-                           urllib.parse.urlencode(query_params))
-
-    if response.status_code != 200:
-        return []
+def parse_composer_query_entries(text):
+    """ Returns list of entries of the composer query response text """
 
     # Parse json response
     try:
-        json_response = json.loads(strip_ajax_response_prefix(response.text))
+        json_response = json.loads(strip_ajax_response_prefix(text))
         return json_response['payload']['entries']
     except json.decoder.JSONDecodeError as e:
         return []
@@ -573,23 +835,53 @@ def get_composer_query_entries(browser, value):
         return []
 
 
-def get_entity_id_from_profile_page(browser, vanity_name):
-    """ Get entity id from a users profile page """
+class ProfilePageScanner:
+    """ Searches a profile page for the entity id while it streams in, decompressing it if it has a content_encoding """
 
-    FACEBOOK_PROFILE_PAGE_ENTITY_ID_REGEXP_STRING = r'entity_id:(\d+),ef_page:'
-    regexp = re.compile(
-        FACEBOOK_PROFILE_PAGE_ENTITY_ID_REGEXP_STRING, re.MULTILINE)
+    ENTITY_ID_REGEXP = re.compile(r'entity_id:(\d+),ef_page:', re.MULTILINE)
 
-    response = browser.get(f'https://m.facebook.com/{vanity_name}')
-    if response.status_code != 200:
-        return None
+    def __init__(self, encoding=None, content_encoding=None):
+        self._decoder = codecs.getincrementaldecoder(
+            encoding or 'utf-8')(errors='replace')
+        # Detects the gzip or zlib header of the body
+        self._decompressor = zlib.decompressobj(
+            32 + zlib.MAX_WBITS) if content_encoding in ('gzip', 'deflate') else None
+        self._buffer = ''
+        self.entity_id = None
 
-    matches = regexp.search(response.text)
+    def feed(self, chunk):
+        """ Add raw bytes of the page as transferred, returns the entity id once it was found """
 
-    if not matches or len(matches.groups()) != 1:
-        return None
+        if self._decompressor:
+            try:
+                chunk = self._decompressor.decompress(chunk)
+            except zlib.error:
+                raise ScrapeError('profile_page_response_invalid')
 
-    return matches[1]
+        self._buffer += self._decoder.decode(chunk)
+        matches = self.ENTITY_ID_REGEXP.search(self._buffer)
+
+        if matches:
+            self.entity_id = matches[1]
+        else:
+            # Keep enough of the end to find a match split between chunks
+            self._buffer = self._buffer[-PROFILE_PAGE_MATCH_OVERLAP:]
+
+        return self.entity_id
+
+
+def record_profile_page_scan(started, read_bytes, content_length, entity_id):
+    """ Record bytes read and saved (content_length is the Content-Length header value) and duration of a profile page scan """
+
+    result = 'match' if entity_id else (
+        'budget' if read_bytes >= PROFILE_PAGE_MAX_BYTES else 'no_match')
+    metrics.increment('bdays_profile_page_bytes_total',
+                      read_bytes, kind='read')
+    if content_length.isdigit():
+        metrics.increment('bdays_profile_page_bytes_total',
+                          max(0, int(content_length) - read_bytes), kind='saved')
+    metrics.observe('bdays_profile_page_scan_seconds',
+                    time.perf_counter() - started, result=result)
 
 
 def strip_ajax_response_prefix(payload):
@@ -600,39 +892,45 @@ def strip_ajax_response_prefix(payload):
     return payload
 
 
-def populate_birthdays_calendar(birthdays):
-    """ Populate a birthdays calendar using birthday objects """
+def serialize_birthdays_calendar(birthdays, today=None):
+    """ Serialize birthday objects into an ics calendar, yielding one chunk per event.
+        Lines are separated by a single carriage return, identical to the output of the ics.Calendar
+        based serializer this replaces (with its blank lines removed). """
 
-    c = Calendar()
-    c.scale = 'GREGORIAN'
-    c.method = 'PUBLISH'
-    c.creator = f'fb2cal'
-    c._unused.append(ics.parse.ContentLine(name='X-WR-CALNAME',
-                                           params={}, value='Facebook Birthdays (fb2cal)'))
-    c._unused.append(ics.parse.ContentLine(
-        name='X-PUBLISHED-TTL', params={}, value='PT12H'))
-    c._unused.append(ics.parse.ContentLine(
-        name='X-ORIGINAL-URL', params={}, value='/events/birthdays/'))
+    if today is None:
+        today = date.today()
 
-    cur_date = datetime.now()
+    yield ('BEGIN:VCALENDAR\r'
+           'X-WR-CALNAME:Facebook Birthdays (fb2cal)\r'
+           'X-PUBLISHED-TTL:PT12H\r'
+           'X-ORIGINAL-URL:/events/birthdays/\r'
+           'PRODID:fb2cal\r'
+           'VERSION:2.0\r'
+           'CALSCALE:GREGORIAN\r'
+           'METHOD:PUBLISH\r')
 
     for birthday in birthdays:
-        e = Event()
-        e.uid = birthday.uid
-        e.name = f"{birthday.name}'s Birthday"
-
         # Calculate the year as this year or next year based on if its past current month or not
-        # Also pad day, month with leading zeros to 2dp
-        year = cur_date.year if birthday.month >= cur_date.month else (
-            cur_date + relativedelta(years=1)).year
-        month = '{:02d}'.format(birthday.month)
-        day = '{:02d}'.format(birthday.day)
-        e.begin = f'{year}-{month}-{day} 00:00:00'
-        e.make_all_day()
-        e.duration = timedelta(days=1)
-        e._unused.append(ics.parse.ContentLine(
-            name='RRULE', params={}, value='FREQ=YEARLY'))
-
-        c.events.add(e)
-
-    return c
+        year = today.year if birthday.month >= today.month else today.year + 1
+
+        # The 29th of February only exists in leap years
+        if (birthday.month, birthday.day) == (2, 29):
+            while not isleap(year):
+                year += 1
+
+        yield ('BEGIN:VEVENT\r'
+               'RRULE:FREQ=YEARLY\r'
+               f'DTSTART;VALUE=DATE:{year}{birthday.month:02d}{birthday.day:02d}\r'
+               'DURATION:P1D\r'
+               f"SUMMARY:{escape_ics_text(birthday.name)}'s Birthday\r"
+               'TRANSP:OPAQUE\r'
+               f'UID:{birthday.uid}\r'
+               'END:VEVENT\r')
+
+    yield 'END:VCALENDAR'
+
+
+def escape_ics_text(text):
+    """ Escape an ics TEXT value """
+
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n').replace('\r', '\\r')
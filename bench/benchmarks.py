@@ -0,0 +1,194 @@
+""" Benchmarks of bdays.py against the local Facebook stand-in (bench/fake_facebook.py)
+
+    python -m bench.benchmarks                      # everything with defaults
+    python -m bench.benchmarks --skip-end-to-end    # microbenchmarks only
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import tempfile
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.fake_facebook import FakeFacebook, start_server
+
+# bdays.py reads its configuration on import, point it at scratch storage first
+_scratch_directory = tempfile.mkdtemp(prefix='facebook-bdays-bench-')
+os.environ.setdefault('VANITY_CACHE_PATH', os.path.join(
+    _scratch_directory, 'vanity.sqlite3'))
+os.environ.setdefault('SESSION_STORE_PATH', os.path.join(
+    _scratch_directory, 'sessions.sqlite3'))
+
+# Measure the scraper itself rather than the outbound rate limits
+for endpoint_class in ('login', 'async_birthdays', 'composer_query', 'profile_page'):
+    os.environ.setdefault(f'RATE_LIMIT_{endpoint_class.upper()}', '0,0')
+
+import bdays  # noqa: E402
+from month_cache import get_month_cache  # noqa: E402
+from session_store import get_session_store  # noqa: E402
+from vanity_cache import get_vanity_cache  # noqa: E402
+
+FRIEND_COUNTS = (100, 1000, 5000)
+
+
+def point_bdays_at(url):
+    bdays.FACEBOOK_URL = url
+    bdays.FACEBOOK_MOBILE_URL = f'{url}/m'
+
+
+def reset_caches():
+    """ Start from a cold month cache, vanity cache and session store so every scrape does the full amount of work """
+
+    month_cache = get_month_cache()
+    with month_cache._lock:
+        month_cache._entries.clear()
+
+    with get_vanity_cache()._connection() as connection:
+        connection.execute('DELETE FROM vanity_cache')
+    with get_session_store()._connection() as connection:
+        connection.execute('DELETE FROM sessions')
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def report(name, samples, unit='ms', scale=1000):
+    print(f'{name:<48} mean {statistics.mean(samples) * scale:9.2f}{unit}  '
+          f'p50 {percentile(samples, 0.5) * scale:9.2f}{unit}  '
+          f'p95 {percentile(samples, 0.95) * scale:9.2f}{unit}  (n={len(samples)})')
+
+
+def bench_end_to_end(friends, latency, error_rate, runs, concurrency, warm):
+    facebook = FakeFacebook(friends, latency, error_rate)
+    server, url = start_server(facebook)
+    point_bdays_at(url)
+
+    def scrape(index):
+        if not warm:
+            reset_caches()
+        started = time.perf_counter()
+        bdays.get_birthdays(f'user{index}@example.com', 'password')
+        return time.perf_counter() - started
+
+    try:
+        # Sequential runs for latency
+        latencies = [scrape(index) for index in range(runs)]
+        report(f'get_birthdays {friends} friends{" (warm)" if warm else ""}', latencies)
+
+        # Concurrent runs for throughput
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(scrape, range(runs)))
+        elapsed = time.perf_counter() - started
+        print(f'{"":<48} throughput {runs / elapsed:8.2f} scrapes/s at concurrency {concurrency}, '
+              f'{sum(facebook.requests.values()) / (2 * runs):.1f} requests/scrape')
+    finally:
+        server.shutdown()
+
+
+def scrape_context(locale='en_US'):
+    """ ScrapeContext usable for parsing without a network round trip """
+
+    context = bdays.ScrapeContext()
+    context.restore('fake-async-token', locale)
+    return context
+
+
+def birthdays_page(facebook, month):
+    """ Raw /async/birthdays/ output of the fake server for a month """
+
+    cards = ''.join(friend.card_html()
+                    for friend in facebook.friends if friend.month == month)
+    return 'for (;;);' + json.dumps({'domops': [['replace', '#birthdays_monthly_card', False,
+                                                 {'__html': f'<ul class="_43q6">{cards}</ul>'}]]})
+
+
+def parse_whole_page(context, text):
+    """ Baseline for BirthdayCardExtractor: the whole response parser it replaced, decodes the full JSON
+        and runs the card regexp over all the card HTML at once """
+
+    try:
+        birthday_card_html = json.loads(bdays.strip_ajax_response_prefix(text))['domops'][0][3]['__html']
+    except (json.decoder.JSONDecodeError, KeyError):
+        raise bdays.ScrapeError('async_birthdays_response_invalid')
+
+    birthdays = []
+    for vanity_name, tooltip_content, name in re.findall(bdays.BIRTHDAY_STRING_REGEXP_STRING,
+                                                         birthday_card_html, re.MULTILINE):
+        bdays.append_birthday(context, birthdays, None, vanity_name, tooltip_content, name)
+
+    return birthdays
+
+
+def bench_micro(friends, number):
+    facebook = FakeFacebook(friends * 12)
+    context = scrape_context()
+
+    # One month worth of friends per page
+    page = birthdays_page(facebook, 1)
+    report(f'parse_whole_page {friends} friends',
+           timeit.repeat(lambda: parse_whole_page(context, page), number=1, repeat=number))
+
+    def extract_cards():
+        extractor = bdays.BirthdayCardExtractor()
+        raw = page.encode()
+        for start in range(0, len(raw), bdays.ASYNC_BIRTHDAYS_CHUNK_SIZE):
+            extractor.feed(raw[start:start + bdays.ASYNC_BIRTHDAYS_CHUNK_SIZE])
+        extractor.finish()
+
+    report(f'BirthdayCardExtractor {friends} friends',
+           timeit.repeat(extract_cards, number=1, repeat=number))
+
+    tooltips = [(f'{friend.name} ({friend.month:02d}/{friend.day:02d})', friend.name)
+                for friend in facebook.friends[:friends]]
+
+    def parse_tooltips():
+        for tooltip_content, name in tooltips:
+            bdays.parse_birthday_day_month(tooltip_content, name, context)
+
+    report(f'parse_birthday_day_month x{friends}',
+           timeit.repeat(parse_tooltips, number=1, repeat=number))
+
+    birthdays = [bdays.Birthday(friend.uid, friend.name, friend.day, friend.month)
+                 for friend in facebook.friends[:friends]]
+    report(f'serialize_birthdays_calendar {friends} friends',
+           timeit.repeat(lambda: ''.join(bdays.serialize_birthdays_calendar(birthdays)), number=1, repeat=number))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--friends', type=lambda value: [int(count) for count in value.split(',')],
+                        default=list(FRIEND_COUNTS), help='comma separated friend list sizes')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds the fake server adds to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of GETs the fake server answers with 503')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--number', type=int, default=20,
+                        help='repetitions of each microbenchmark')
+    parser.add_argument('--skip-end-to-end', action='store_true')
+    parser.add_argument('--skip-micro', action='store_true')
+    args = parser.parse_args()
+
+    if not args.skip_micro:
+        for friends in args.friends:
+            bench_micro(friends, args.number)
+
+    if not args.skip_end_to_end:
+        for friends in args.friends:
+            bench_end_to_end(friends, args.latency, args.error_rate,
+                             args.runs, args.concurrency, warm=False)
+            bench_end_to_end(friends, args.latency, args.error_rate,
+                             args.runs, args.concurrency, warm=True)
+
+
+if __name__ == '__main__':
+    main()
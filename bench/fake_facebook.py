@@ -0,0 +1,218 @@
+""" Local stand-in for the Facebook endpoints used by bdays.py
+
+    Run standalone with `python -m bench.fake_facebook --friends 1000` and point bdays.py at it with
+    FACEBOOK_URL=http://127.0.0.1:<port> FACEBOOK_MOBILE_URL=http://127.0.0.1:<port>/m
+"""
+
+import argparse
+import html
+import sys
+import json
+import random
+import threading
+import time
+import urllib.parse
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytz
+
+AJAX_PREFIX = 'for (;;);'
+ASYNC_TOKEN = 'fake-async-token'
+DATR_TOKEN = 'fake-datr-token'
+
+FIRST_NAMES = ['Anna', 'Bence', 'Csilla', 'Dániel', 'Emma', 'Ferenc', 'Gréta', 'Zoë', "O'Neil", 'Jo & Co']
+LAST_NAMES = ['Kovács', 'Nagy', 'Smith', 'Tóth', 'Doe', 'Szabó', 'Müller']
+
+
+class Friend:
+    def __init__(self, index):
+        self.uid = str(100000000000000 + index)
+        self.name = f'{FIRST_NAMES[index % len(FIRST_NAMES)]} {LAST_NAMES[index % len(LAST_NAMES)]} {index}'
+        self.month = index % 12 + 1
+        self.day = index * 7 % 28 + 1
+
+        # Mix of friends without vanity names, resolvable by composer query and only resolvable from their profile page
+        if index % 3 == 0:
+            self.vanity_name = None
+        else:
+            self.vanity_name = f'friend.{index}'
+        self.composer_resolvable = index % 3 == 1
+
+    @property
+    def profile_path(self):
+        return self.vanity_name or f'profile.php?id={self.uid}'
+
+    def card_html(self):
+        name = html.escape(self.name)
+        return (f'<li class="_43q7"><a href="https://www.facebook.com/{self.profile_path}" '
+                f'data-hover="tooltip" data-tooltip-content="{name} ({self.month:02d}/{self.day:02d})">'
+                f'<img class="_s0 _4ooo _1ve7 _rw img" src="https://example.com/{self.uid}.jpg" alt="{name}" />'
+                f'</a></li>')
+
+
+class FakeFacebook:
+    """ Friend list plus behaviour knobs shared by all request handlers """
+
+    def __init__(self, friends=100, latency=0.0, error_rate=0.0, locale='en_US', seed=0):
+        self.friends = [Friend(index) for index in range(friends)]
+        self.friends_by_vanity_name = {
+            friend.vanity_name: friend for friend in self.friends if friend.vanity_name}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.locale = locale
+        self.random = random.Random(seed)
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    def count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def should_fail(self):
+        with self._lock:
+            return self.random.random() < self.error_rate
+
+
+class FakeFacebookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def facebook(self):
+        return self.server.facebook
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, status=200, content_type='text/html; charset=utf-8', headers=None):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_ajax(self, payload):
+        self.send_body(AJAX_PREFIX + json.dumps(payload),
+                       content_type='application/x-javascript; charset=utf-8')
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        endpoint = url.path
+
+        self.facebook.count(endpoint)
+
+        if self.facebook.latency:
+            time.sleep(self.facebook.latency)
+
+        if self.facebook.should_fail():
+            self.send_body('Sorry, something went wrong.', status=503)
+            return
+
+        if endpoint == '/login.php':
+            self.send_body(f'<html><head><script>requireLazy(["_js_datr","{DATR_TOKEN}"])</script></head><body>'
+                           '<form id="login_form" method="post" action="/login.php">'
+                           '<input type="email" id="email" name="email" />'
+                           '<input type="password" id="pass" name="pass" />'
+                           '<input type="submit" value="Log In" /></form></body></html>')
+        elif endpoint == '/events/birthdays/':
+            self.send_body(
+                f'<script>{{"token":"fake-token","async_get_token":"{ASYNC_TOKEN}"}}</script>')
+        elif endpoint == '/ajax/settings/language/account.php':
+            self.send_ajax({'jsmods': {'require': [
+                ['LocaleSettings', 'init', [], [None, {'currentLocale': self.facebook.locale}]]]}})
+        elif endpoint == '/async/birthdays/':
+            self.send_birthdays(query)
+        elif endpoint == '/ajax/mercury/composer_query.php':
+            self.send_composer_query(query)
+        elif endpoint.startswith('/m/'):
+            self.send_profile_page(endpoint[3:])
+        else:
+            self.send_body('Not found', status=404)
+
+    def do_POST(self):
+        self.facebook.count('POST ' + self.path)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        self.send_body('<html><head><link rel="canonical" href="https://www.facebook.com/" /></head></html>',
+                       headers={'Set-Cookie': 'c_user=1; Path=/'})
+
+    def send_birthdays(self, query):
+        if query.get('fb_dtsg_ag') != ASYNC_TOKEN:
+            self.send_body('Bad token', status=400)
+            return
+
+        month = datetime.fromtimestamp(int(query['date']), pytz.timezone(
+            'America/Los_Angeles')).month
+        cards = ''.join(friend.card_html()
+                        for friend in self.facebook.friends if friend.month == month)
+
+        self.send_ajax({'domops': [['replace', '#birthdays_monthly_card', False,
+                                    {'__html': f'<ul class="_43q6">{cards}</ul>'}]]})
+
+    def send_composer_query(self, query):
+        friend = self.facebook.friends_by_vanity_name.get(query.get('value'))
+        entries = []
+
+        if friend and friend.composer_resolvable:
+            entries.append({'uid': int(friend.uid), 'alias': friend.vanity_name,
+                            'vertical_type': 'USER', 'render_type': 'friend'})
+
+        self.send_ajax({'payload': {'entries': entries}})
+
+    def send_profile_page(self, vanity_name):
+        friend = self.facebook.friends_by_vanity_name.get(vanity_name)
+        if friend is None:
+            self.send_body('Not found', status=404)
+            return
+
+        # Mobile profile pages are large, the entity id sits somewhere in the middle
+        filler = '<div class="filler">' + 'x' * 2000 + '</div>'
+        self.send_body(f'<html><body>{filler * 20}<script>({{entity_id:{friend.uid},ef_page:null}})</script>'
+                       f'{filler * 20}</body></html>')
+
+
+class FakeFacebookServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients hang up early on purpose (e.g. profile pages are only read up to the entity id)
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+def start_server(facebook, host='127.0.0.1', port=0):
+    """ Serve facebook in a background thread, returns (server, base url) """
+
+    server = FakeFacebookServer((host, port), FakeFacebookHandler)
+    server.daemon_threads = True
+    server.facebook = facebook
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f'http://{host}:{server.server_port}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--friends', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of GETs answered with 503')
+    parser.add_argument('--port', type=int, default=8500)
+    args = parser.parse_args()
+
+    server, url = start_server(FakeFacebook(args.friends, args.latency, args.error_rate),
+                               port=args.port)
+    print(f'FACEBOOK_URL={url} FACEBOOK_MOBILE_URL={url}/m')
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
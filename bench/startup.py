@@ -0,0 +1,59 @@
+""" Startup benchmark: import time of bdays.py, warm_up cost and first request latency with and without warm_up
+
+    python -m bench.startup
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+# Runs in a fresh interpreter, prints the measured durations in seconds
+MEASURE_SCRIPT = '''
+import time
+started = time.perf_counter()
+import bdays
+imported = time.perf_counter()
+if {warm}:
+    bdays.warm_up()
+warmed = time.perf_counter()
+
+# First request work that doesn't need the network
+import async_bdays
+context = async_bdays.AsyncScrapeContext(None)
+context.restore('token', 'en_US')
+bdays.get_month_epoch_timestamps()
+extractor = bdays.BirthdayCardExtractor()
+for card in extractor.feed(b'for (;;);{{"domops": [[null, null, null, {{"__html": ""}}]]}}') + extractor.finish():
+    bdays.append_birthday_card(context, [], None, card)
+bdays.get_locale_date_parser('en_US').get_day_name_offset_dict(__import__('datetime').date.today())
+first_request = time.perf_counter()
+
+print(imported - started, warmed - imported, first_request - warmed)
+'''
+
+
+def measure(warm, runs):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', MEASURE_SCRIPT.format(warm=warm)],
+                                check=True, capture_output=True, text=True).stdout
+        samples.append([float(value) for value in output.split()])
+    return [statistics.median(column) for column in zip(*samples)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    for warm in (False, True):
+        import_seconds, warm_up_seconds, first_request_seconds = measure(
+            warm, args.runs)
+        print(f'{"with" if warm else "without"} warm_up: import {import_seconds * 1000:8.1f}ms  '
+              f'warm_up {warm_up_seconds * 1000:8.1f}ms  first request {first_request_seconds * 1000:8.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+""" Checkpoints of partial scrapes, letting a retry fetch only what failed before """
+
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+# Seconds a checkpoint can be resumed after its last attempt
+CHECKPOINT_TTL = 60 * 60
+
+CHECKPOINT_MAX_ENTRIES = 1024
+
+
+class ScrapeCheckpoint:
+    """ Months completed so far by a partial scrape and the failures of its last attempt """
+
+    def __init__(self, account, scrape_id=None):
+        self.scrape_id = scrape_id or secrets.token_urlsafe(16)
+        # Account key (see result_cache.account_key), a checkpoint is only resumed by the same account
+        self.account = account
+        # Epoch timestamp of a month -> its birthdays, only for months without any failures
+        self.months = {}
+        self.failures = []
+        self.attempts = 0
+        self.updated_at = time.time()
+        self._lock = threading.Lock()
+
+    def start_attempt(self):
+        """ Forget the failures of the previous attempt """
+
+        with self._lock:
+            self.failures = []
+            self.attempts += 1
+            self.updated_at = time.time()
+
+    def add_failure(self, stage, reason, month=None, item=None):
+        """ Record a failure of stage (month, card or vanity) in the month starting at epoch timestamp month """
+
+        with self._lock:
+            self.failures.append(
+                {'stage': stage, 'reason': reason, 'month': month, 'item': item})
+
+    def complete_month(self, month, birthdays):
+        with self._lock:
+            self.months[month] = list(birthdays)
+
+    def failed_months(self):
+        with self._lock:
+            return {failure['month'] for failure in self.failures}
+
+    @property
+    def complete(self):
+        with self._lock:
+            return not self.failures
+
+    def to_dict(self):
+        with self._lock:
+            return {'scrape_id': self.scrape_id, 'complete': not self.failures, 'attempts': self.attempts,
+                    'completed_months': sorted(self.months), 'failures': list(self.failures)}
+
+
+class CheckpointStore:
+    """ In memory store of scrape checkpoints by scrape id """
+
+    def __init__(self, ttl=CHECKPOINT_TTL, max_entries=CHECKPOINT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._checkpoints = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, account):
+        checkpoint = ScrapeCheckpoint(account)
+
+        with self._lock:
+            self._checkpoints[checkpoint.scrape_id] = checkpoint
+
+            while len(self._checkpoints) > self.max_entries:
+                self._checkpoints.popitem(last=False)
+
+        return checkpoint
+
+    def get(self, scrape_id, account=None):
+        """ Returns the unexpired checkpoint of scrape_id (if it belongs to account when given) or None """
+
+        with self._lock:
+            checkpoint = self._checkpoints.get(scrape_id)
+            if checkpoint is None:
+                return None
+
+            if time.time() - checkpoint.updated_at >= self.ttl:
+                del self._checkpoints[scrape_id]
+                return None
+
+            if account is not None and not secrets.compare_digest(checkpoint.account, account):
+                return None
+
+            self._checkpoints.move_to_end(scrape_id)
+            return checkpoint
+
+
+__checkpoint_store = None
+__checkpoint_store_lock = threading.Lock()
+
+
+def get_checkpoint_store():
+    """ Returns the process wide checkpoint store """
+
+    global __checkpoint_store
+
+    with __checkpoint_store_lock:
+        if __checkpoint_store is None:
+            __checkpoint_store = CheckpointStore()
+
+    return __checkpoint_store
@@ -0,0 +1,42 @@
+""" HTTP content encodings shared by the static frontend and the calendar responses """
+
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    # Only gzip without brotli
+    brotli = None
+
+# Content-Encoding and file suffix of every encoding, most preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# Slowest, best levels, for compressing once at build time
+MAX_COMPRESSION_LEVELS = {'br': 11, 'gzip': 9}
+
+
+def available_encodings():
+    """ Returns (Content-Encoding, suffix) of the encodings that can be produced """
+
+    return [(encoding, suffix) for encoding, suffix in ENCODINGS if encoding != 'br' or brotli is not None]
+
+
+def compress(data, encoding, level):
+    """ Returns bytes data compressed for the Content-Encoding encoding at level (brotli quality or gzip level) """
+
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+
+    # No timestamp in the header so compressing the same data twice gives the same bytes
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def negotiate_encoding(accept_encodings, encodings):
+    """ Returns the most preferred of encodings accepted by a request (its werkzeug accept_encodings),
+        None for the identity encoding """
+
+    for encoding, _ in ENCODINGS:
+        if encoding in encodings and accept_encodings.quality(encoding) > 0:
+            return encoding
+
+    return None
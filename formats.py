@@ -0,0 +1,67 @@
+""" Output formats of the birthdays of a scrape """
+
+import csv
+import io
+import json
+
+from bdays import serialize_birthdays_calendar
+
+# Fields of a Birthday in the JSON and CSV formats
+BIRTHDAY_FIELDS = ('uid', 'name', 'day', 'month')
+
+
+def serialize_ics(birthdays):
+    return ''.join(serialize_birthdays_calendar(birthdays))
+
+
+def serialize_json(birthdays):
+    """ Columnar JSON, an array per field: {"uid": [...], "name": [...], "day": [...], "month": [...]} """
+
+    return json.dumps({field: [getattr(birthday, field) for birthday in birthdays] for field in BIRTHDAY_FIELDS},
+                      ensure_ascii=False, separators=(',', ':'))
+
+
+def serialize_csv(birthdays):
+    """ CSV with a header row """
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(BIRTHDAY_FIELDS)
+    writer.writerows([getattr(birthday, field) for field in BIRTHDAY_FIELDS]
+                     for birthday in birthdays)
+
+    return output.getvalue()
+
+
+# Format name -> (Content-Type, serializer), in order of preference when the client accepts several
+FORMATS = {
+    'ics': ('text/calendar', serialize_ics),
+    'json': ('application/json', serialize_json),
+    'csv': ('text/csv', serialize_csv),
+}
+
+DEFAULT_FORMAT = 'ics'
+
+
+def serialize_birthdays(birthdays, output_format=DEFAULT_FORMAT):
+    """ Serialize a list of birthday objects into output_format (a FORMATS name) """
+
+    return FORMATS[output_format][1](birthdays)
+
+
+def format_content_type(output_format):
+    return FORMATS[output_format][0]
+
+
+def negotiate_format(accept_mimetypes):
+    """ Returns the name of the format preferred by a request (its werkzeug accept_mimetypes), the default one
+        if it accepts none of them """
+
+    content_type = accept_mimetypes.best_match(
+        [content_type for content_type, _ in FORMATS.values()])
+
+    for output_format, (candidate_content_type, _) in FORMATS.items():
+        if candidate_content_type == content_type:
+            return output_format
+
+    return DEFAULT_FORMAT
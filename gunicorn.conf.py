@@ -0,0 +1,10 @@
+import os
+
+# Import app.py (and run bdays.warm_up) once in the master, forked workers share it copy-on-write
+preload_app = True
+
+wsgi_app = "app:app"
+
+# Scrapes run on each worker's event loop (see async_bdays.py), request threads only wait for them
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 200))
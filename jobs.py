@@ -0,0 +1,121 @@
+""" Background scrape jobs so HTTP requests don't have to wait for a whole scrape """
+
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bdays import failure_reason
+
+# Number of scrapes running at the same time
+JOB_MAX_WORKERS = 4
+
+# Number of jobs allowed to wait for a free worker before new jobs are rejected
+JOB_MAX_QUEUED = 16
+
+# Seconds a finished job (and its result) is kept around for the client to collect it
+JOB_RETENTION = 10 * 60
+
+
+class JobQueueFull(Exception):
+    """ Raised when a job is submitted while the executor and its queue are full """
+
+
+class Job:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self):
+        # Job ids double as the capability to read the result so they have to be unguessable
+        self.id = secrets.token_urlsafe(24)
+        self.status = Job.QUEUED
+        self.events = []
+        self.result = None
+        # Reason of the failure of a failed job (ScrapeError.reason or the exception type)
+        self.error = None
+        self.finished_at = None
+        self._condition = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in (Job.DONE, Job.FAILED)
+
+    def add_event(self, event):
+        with self._condition:
+            self.events.append(event)
+            self._condition.notify_all()
+
+    def _set_status(self, status, result=None, error=None):
+        with self._condition:
+            self.status = status
+            self.result = result
+            self.error = error
+            if self.finished:
+                self.finished_at = time.monotonic()
+            self.events.append({'phase': status, 'error': error} if error else {'phase': status})
+            self._condition.notify_all()
+
+    def wait_for_events(self, start, timeout=None):
+        """ Returns events after index start, blocking up to timeout seconds until there is at least one """
+
+        with self._condition:
+            self._condition.wait_for(lambda: len(
+                self.events) > start or self.finished, timeout)
+            return self.events[start:]
+
+    def to_dict(self):
+        with self._condition:
+            job = {'id': self.id, 'status': self.status, 'events': list(self.events)}
+            if self.error:
+                job['error'] = self.error
+            return job
+
+
+class JobManager:
+    """ Runs scrape jobs on a bounded executor and keeps them until they are collected or expire """
+
+    def __init__(self, max_workers=JOB_MAX_WORKERS, max_queued=JOB_MAX_QUEUED, retention=JOB_RETENTION):
+        self.max_pending = max_workers + max_queued
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """ Queue fn(*args, progress=job.add_event, **kwargs), raises JobQueueFull if too many jobs are pending """
+
+        job = Job()
+
+        with self._lock:
+            self._expire()
+
+            if sum(1 for pending in self._jobs.values() if not pending.finished) >= self.max_pending:
+                raise JobQueueFull
+
+            self._jobs[job.id] = job
+
+        self._executor.submit(self._run, job, fn, args, kwargs)
+
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, fn, args, kwargs):
+        job._set_status(Job.RUNNING)
+
+        try:
+            result = fn(*args, progress=job.add_event, **kwargs)
+        except Exception as e:
+            job._set_status(Job.FAILED, error=failure_reason(e))
+        else:
+            job._set_status(Job.DONE, result)
+
+    def _expire(self):
+        now = time.monotonic()
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished and now - job.finished_at > self.retention]:
+            del self._jobs[job_id]
@@ -0,0 +1,146 @@
+""" Process wide metrics (counters and latency histograms) with Prometheus text export and Server-Timing support """
+
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+# Timings of the phases of the current request, see track_timings
+_current_timings = contextvars.ContextVar('timings', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class Timings:
+    """ Phase durations of one request, rendered as a Server-Timing header """
+
+    def __init__(self):
+        self.entries = []
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.entries.append((name, seconds))
+
+    def server_timing(self):
+        with self._lock:
+            return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.entries)
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def increment(name, amount=1, **labels):
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    with _lock:
+        key = _key(name, labels)
+        if key not in _histograms:
+            _histograms[key] = Histogram()
+        _histograms[key].observe(value)
+
+
+def start_timings():
+    """ Start collecting phase timings for the current request and return them """
+
+    timings = Timings()
+    _current_timings.set(timings)
+    return timings
+
+
+def current_timings():
+    return _current_timings.get()
+
+
+def use_timings(timings):
+    """ Report phase timings of the current context (e.g. a task scraping for another thread's request) to timings """
+
+    _current_timings.set(timings)
+
+
+@contextmanager
+def timed(phase, timings=None, **labels):
+    """ Record the duration of the block in the bdays_phase_seconds histogram.
+        Worker threads don't inherit the request context so they have to pass timings explicitly. """
+
+    if timings is None:
+        timings = current_timings()
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        observe('bdays_phase_seconds', elapsed, phase=phase)
+        if timings is not None:
+            timings.add('-'.join([phase] + [str(value)
+                                            for value in labels.values()]), elapsed)
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def export_prometheus():
+    """ Returns all metrics in the Prometheus text exposition format """
+
+    lines = []
+
+    with _lock:
+        for name in sorted({name for name, _ in _counters}):
+            lines.append(f'# TYPE {name} counter')
+            for (counter_name, labels), value in sorted(_counters.items()):
+                if counter_name == name:
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+
+        for name in sorted({name for name, _ in _histograms}):
+            lines.append(f'# TYPE {name} histogram')
+            for (histogram_name, labels), histogram in sorted(_histograms.items(), key=lambda item: item[0]):
+                if histogram_name != name:
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(
+                        f'{name}_bucket{_format_labels(labels, [("le", _format_bound(bound))])} {cumulative}')
+                lines.append(
+                    f'{name}_sum{_format_labels(labels)} {histogram.sum}')
+                lines.append(
+                    f'{name}_count{_format_labels(labels)} {histogram.count}')
+
+    return '\n'.join(lines) + '\n'
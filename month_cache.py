@@ -0,0 +1,82 @@
+""" Cache of the birthdays of each scraped month with shorter TTLs for the months closest to today """
+
+import threading
+import time
+from collections import OrderedDict
+
+# Number of months starting from the current one that use the near TTL
+MONTH_CACHE_NEAR_MONTHS = 2
+
+# Near months are refreshed on every result cache refresh (see RESULT_CACHE_TTL), distant months rarely change
+MONTH_CACHE_NEAR_TTL = 6 * 60 * 60
+MONTH_CACHE_FAR_TTL = 3 * 24 * 60 * 60
+
+MONTH_CACHE_MAX_ENTRIES = 256 * 12
+
+
+class MonthCache:
+    """ In memory LRU cache of birthday lists keyed by account key and month epoch timestamp """
+
+    def __init__(self, near_months=MONTH_CACHE_NEAR_MONTHS, near_ttl=MONTH_CACHE_NEAR_TTL,
+                 far_ttl=MONTH_CACHE_FAR_TTL, max_entries=MONTH_CACHE_MAX_ENTRIES):
+        self.near_months = near_months
+        self.near_ttl = near_ttl
+        self.far_ttl = far_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def ttl(self, month_offset):
+        """ Returns the TTL of a month month_offset months away from the current one """
+
+        return self.near_ttl if month_offset < self.near_months else self.far_ttl
+
+    def get_many(self, account, epoch_timestamps):
+        """ Returns dict of epoch timestamp -> birthdays for the months of epoch_timestamps that are still fresh """
+
+        now = time.time()
+        months = {}
+
+        with self._lock:
+            for epoch_timestamp in epoch_timestamps:
+                key = (account, epoch_timestamp)
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+
+                birthdays, expires_at = entry
+                if expires_at <= now:
+                    del self._entries[key]
+                    continue
+
+                self._entries.move_to_end(key)
+                months[epoch_timestamp] = birthdays
+
+        return months
+
+    def set(self, account, epoch_timestamp, month_offset, birthdays):
+        """ Cache birthdays of the month at epoch_timestamp, month_offset months away from the current one """
+
+        with self._lock:
+            key = (account, epoch_timestamp)
+            self._entries[key] = (list(birthdays), time.time() + self.ttl(month_offset))
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+__month_cache = None
+__month_cache_lock = threading.Lock()
+
+
+def get_month_cache():
+    """ Returns the process wide month cache """
+
+    global __month_cache
+
+    with __month_cache_lock:
+        if __month_cache is None:
+            __month_cache = MonthCache()
+
+    return __month_cache
@@ -0,0 +1,209 @@
+""" Token bucket rate limits of outbound Facebook requests shared by every scrape, with fair queueing between users """
+
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process limits on platforms without flock
+    fcntl = None
+
+
+def _parse_rate_limit(value):
+    rate, burst = value.split(',')
+    return float(rate), float(burst)
+
+
+# Requests per second and burst size of each endpoint class, e.g. RATE_LIMIT_LOGIN=0.5,2 (a rate of 0 disables the limit)
+RATE_LIMITS = {
+    endpoint_class: _parse_rate_limit(os.environ.get(
+        f'RATE_LIMIT_{endpoint_class.upper()}', default))
+    for endpoint_class, default in (('login', '1,3'),
+                                    ('async_birthdays', '10,24'),
+                                    ('composer_query', '10,20'),
+                                    ('profile_page', '2,4'))
+}
+
+# Transport endpoints (see transport.endpoint_name) that are limited together with another class
+ENDPOINT_RATE_LIMIT_CLASSES = {
+    'async_token': 'login',
+    'locale': 'login',
+}
+
+# Optional directory of bucket state files shared (under flock) by every process on the host
+RATE_LIMIT_STATE_DIR = os.environ.get('RATE_LIMIT_STATE_DIR')
+
+
+class TokenBucket:
+    """ Token bucket handing out tokens to waiting users round robin, so one user's burst of requests
+        (e.g. a large friend list) queues behind the requests of everyone else instead of starving them.
+        Waiters are futures of the scrape event loop (see async_bdays.py), the bucket must only be used on it. """
+
+    def __init__(self, name, rate, burst, state_dir=RATE_LIMIT_STATE_DIR):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+        self.state_path = os.path.join(
+            state_dir, f'{name}.json') if state_dir and fcntl else None
+
+        # user -> deque of waiting tickets, in the order users get their next turn
+        self._queues = OrderedDict()
+        # Resolved (and replaced) whenever the queues change, created on the loop by the first waiter
+        self._changed = None
+
+    async def acquire(self, user=None):
+        """ Wait until a token is available and it is user's turn, returns seconds waited.
+            A cancelled waiter leaves the queue without taking a token. """
+
+        started = time.monotonic()
+        ticket = object()
+
+        self._queues.setdefault(user, deque()).append(ticket)
+
+        try:
+            while True:
+                if self._is_next(user, ticket):
+                    wait = self._take()
+                    if wait <= 0:
+                        break
+                else:
+                    wait = None
+
+                await self._wait_for_change(wait)
+        finally:
+            self._dequeue(user, ticket)
+            self._notify()
+
+        waited = time.monotonic() - started
+        metrics.observe('bdays_rate_limit_wait_seconds',
+                        waited, endpoint=self.name)
+
+        return waited
+
+    async def _wait_for_change(self, timeout):
+        """ Wait until the queues change or timeout seconds (None for no timeout) pass """
+
+        if self._changed is None:
+            self._changed = asyncio.get_running_loop().create_future()
+
+        try:
+            # Shielded as the future is shared by every waiter, a timeout must only end this wait
+            await asyncio.wait_for(asyncio.shield(self._changed), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _notify(self):
+        if self._changed is not None and not self._changed.done():
+            self._changed.set_result(None)
+        self._changed = None
+
+    def _is_next(self, user, ticket):
+        next_user, queue = next(iter(self._queues.items()))
+        return next_user == user and queue[0] is ticket
+
+    def _dequeue(self, user, ticket):
+        queue = self._queues[user]
+        was_next = queue[0] is ticket
+        queue.remove(ticket)
+
+        if not queue:
+            del self._queues[user]
+        elif was_next:
+            # Served users go to the back of the line
+            self._queues.move_to_end(user)
+
+    def _take(self):
+        """ Take a token if there is one, returns 0 on success or seconds until the next token """
+
+        if self.state_path:
+            return self._take_shared()
+
+        now = time.monotonic()
+        self.tokens, self.updated = self._refill(self.tokens, self.updated, now)
+
+        return self._take_from_tokens()
+
+    def _take_shared(self):
+        # The lock is only held for a read and a write of a tiny file, short enough to take on the event loop
+        # Bucket state is kept in wall clock time as monotonic clocks aren't comparable between processes
+        with open(self.state_path, 'a+') as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                state_file.seek(0)
+                try:
+                    self.tokens, self.updated = json.load(state_file)
+                except ValueError:
+                    self.tokens, self.updated = self.burst, time.time()
+
+                now = time.time()
+                self.tokens, self.updated = self._refill(
+                    self.tokens, self.updated, now)
+                wait = self._take_from_tokens()
+
+                state_file.seek(0)
+                state_file.truncate()
+                json.dump([self.tokens, self.updated], state_file)
+            finally:
+                fcntl.flock(state_file, fcntl.LOCK_UN)
+
+        return wait
+
+    def _refill(self, tokens, updated, now):
+        return min(self.burst, tokens + max(0, now - updated) * self.rate), now
+
+    def _take_from_tokens(self):
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """ Token buckets of all endpoint classes """
+
+    def __init__(self, rate_limits=RATE_LIMITS, state_dir=RATE_LIMIT_STATE_DIR):
+        self.buckets = {
+            endpoint_class: TokenBucket(endpoint_class, rate, burst, state_dir)
+            for endpoint_class, (rate, burst) in rate_limits.items() if rate > 0
+        }
+
+    def bucket(self, endpoint):
+        """ Returns the token bucket of endpoint (a transport.endpoint_name), None if it isn't limited """
+
+        return self.buckets.get(ENDPOINT_RATE_LIMIT_CLASSES.get(endpoint, endpoint))
+
+    async def acquire(self, endpoint, user=None):
+        """ Wait for a request to endpoint on behalf of user, returns seconds waited """
+
+        bucket = self.bucket(endpoint)
+        if bucket is None:
+            return 0
+
+        return await bucket.acquire(user)
+
+
+__rate_limiter = None
+__rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """ Returns the process wide rate limiter """
+
+    global __rate_limiter
+
+    with __rate_limiter_lock:
+        if __rate_limiter is None:
+            __rate_limiter = RateLimiter()
+
+    return __rate_limiter
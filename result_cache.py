@@ -0,0 +1,225 @@
+""" Cache of generated calendars keyed by a salted hash of the account credentials """
+
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from compression import compress
+
+# Calendars advertise X-PUBLISHED-TTL:PT12H so clients won't expect anything fresher
+RESULT_CACHE_TTL = 12 * 60 * 60
+
+RESULT_CACHE_MAX_ENTRIES = 256
+
+# Compression levels of calendar responses, calendars compress about tenfold even at these cheap levels
+RESULT_COMPRESSION_LEVELS = {'br': 5, 'gzip': 6}
+
+# Optional directory for a cache tier shared between processes
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR')
+
+# Entries kept in the disk tier, a sweep removes the oldest ones above this
+RESULT_CACHE_MAX_FILES = int(os.environ.get('RESULT_CACHE_MAX_FILES', 4096))
+
+# Seconds between sweeps of the disk tier by each process, expired entries nobody reads again are removed by them
+RESULT_CACHE_SWEEP_INTERVAL = 10 * 60
+
+# Secret salt of the account hashes, must be set (and shared) for the disk tier to be useful across processes
+RESULT_CACHE_SALT = os.environ.get(
+    'RESULT_CACHE_SALT', '').encode() or secrets.token_bytes(32)
+
+
+def account_key(email, password, salt=RESULT_CACHE_SALT):
+    """ Returns the cache key of an account, credentials are never stored.
+        The password is part of the key so a calendar is only served to someone who could scrape it themselves. """
+
+    return hmac.new(salt, f'{email.strip().lower()}\0{password}'.encode(), hashlib.sha256).hexdigest()
+
+
+class CachedResult:
+    def __init__(self, body, created_at, expires_at, etag=None, content_type='text/calendar'):
+        self.body = body
+        self.content_type = content_type
+        self.created_at = created_at
+        self.expires_at = expires_at
+        self.etag = etag or hashlib.sha256(body.encode()).hexdigest()[:32]
+        # Content-Encoding (None for identity) -> bytes of the body
+        self._encoded_bodies = {}
+
+    @property
+    def expired(self):
+        return time.time() >= self.expires_at
+
+    def encoded_body(self, encoding=None):
+        """ Returns the body as bytes compressed for the Content-Encoding encoding, None for uncompressed.
+            Each encoding is compressed once and reused for as long as the result is cached. """
+
+        encoded_body = self._encoded_bodies.get(encoding)
+        if encoding is not None:
+            metrics.increment('bdays_cache_requests_total', cache='compressed',
+                              result='hit' if encoded_body is not None else 'miss')
+
+        if encoded_body is None:
+            if encoding is None:
+                encoded_body = self.body.encode()
+            else:
+                body = self.encoded_body()
+                started = time.thread_time()
+                encoded_body = compress(
+                    body, encoding, RESULT_COMPRESSION_LEVELS[encoding])
+                metrics.observe('bdays_compression_cpu_seconds',
+                                time.thread_time() - started, encoding=encoding)
+                metrics.increment('bdays_compression_bytes_total',
+                                  len(body), encoding=encoding, kind='in')
+                metrics.increment('bdays_compression_bytes_total',
+                                  len(encoded_body), encoding=encoding, kind='out')
+
+            self._encoded_bodies[encoding] = encoded_body
+
+        return encoded_body
+
+    def to_dict(self):
+        return {'body': self.body, 'created_at': self.created_at, 'expires_at': self.expires_at, 'etag': self.etag,
+                'content_type': self.content_type}
+
+
+class ResultCache:
+    """ In memory LRU cache of calendars with an optional on disk tier, swept of expired entries and bounded
+        to max_files (oldest written first) every RESULT_CACHE_SWEEP_INTERVAL """
+
+    def __init__(self, ttl=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_MAX_ENTRIES, directory=RESULT_CACHE_DIR,
+                 max_files=RESULT_CACHE_MAX_FILES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_files = max_files
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # The first write sweeps, entries may be left over from earlier processes
+        self._swept_at = 0
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def get(self, key):
+        """ Returns the unexpired CachedResult of key or None """
+
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                if not result.expired:
+                    self._entries.move_to_end(key)
+                    return result
+                del self._entries[key]
+
+        result = self._read(key)
+        if result is not None:
+            self._remember(key, result)
+
+        return result
+
+    def set(self, key, body, content_type='text/calendar'):
+        """ Cache body under key and return its CachedResult """
+
+        now = time.time()
+        result = CachedResult(body, now, now + self.ttl,
+                              content_type=content_type)
+
+        self._remember(key, result)
+        self._write(key, result)
+
+        return result
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def _read(self, key):
+        if not self.directory:
+            return None
+
+        try:
+            with open(self._path(key), encoding='utf-8') as cache_file:
+                result = CachedResult(**json.load(cache_file))
+        except (OSError, ValueError, TypeError):
+            return None
+
+        if result.expired:
+            self._remove(self._path(key))
+            return None
+
+        return result
+
+    def _write(self, key, result):
+        if not self.directory:
+            return
+
+        # Write to a temporary file first so readers never see a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as cache_file:
+                json.dump(result.to_dict(), cache_file)
+            os.replace(temp_path, self._path(key))
+        except OSError:
+            self._remove(temp_path)
+
+        now = time.time()
+        with self._lock:
+            sweep = now - self._swept_at >= RESULT_CACHE_SWEEP_INTERVAL
+            if sweep:
+                self._swept_at = now
+
+        if sweep:
+            self._sweep(now)
+
+    def _sweep(self, now):
+        """ Remove the expired entries (and abandoned temporary files) of the disk tier, then the oldest entries above
+            max_files. Entries are as old as their file, other processes may be sweeping at the same time. """
+
+        entries = []
+        expired = 0
+
+        try:
+            with os.scandir(self.directory) as directory_entries:
+                for directory_entry in directory_entries:
+                    try:
+                        written_at = directory_entry.stat().st_mtime
+                    except OSError:
+                        continue
+
+                    if written_at + self.ttl <= now:
+                        expired += self._remove(directory_entry.path)
+                    elif directory_entry.name.endswith('.json'):
+                        entries.append((written_at, directory_entry.path))
+        except OSError:
+            return
+
+        entries.sort()
+        evicted = sum(self._remove(path)
+                      for _, path in entries[:max(0, len(entries) - self.max_files)])
+
+        metrics.increment('bdays_result_cache_removals_total', expired, reason='expired')
+        metrics.increment('bdays_result_cache_removals_total', evicted, reason='evicted')
+
+    @staticmethod
+    def _remove(path):
+        """ Remove a file of the disk tier, returns whether it was there """
+
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
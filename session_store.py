@@ -0,0 +1,128 @@
+""" Encrypted, expiring store of logged in Facebook sessions (cookies and async token) """
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+
+import requests
+from cryptography.fernet import Fernet, InvalidToken
+
+SESSION_STORE_PATH = os.environ.get('SESSION_STORE_PATH', os.path.join(
+    tempfile.gettempdir(), 'facebook-bdays-sessions.sqlite3'))
+
+# Facebook sessions last much longer but stale ones are cheap to detect and replace
+SESSION_STORE_TTL = 7 * 24 * 60 * 60
+
+# Secret mixed into the lookup and encryption keys, must be set (and shared) for sessions to be reused across processes
+SESSION_STORE_SECRET = os.environ.get(
+    'SESSION_STORE_SECRET', '').encode() or secrets.token_bytes(32)
+
+# PBKDF2 iterations deriving the encryption key from the account password
+SESSION_STORE_KEY_ITERATIONS = 100000
+
+# Cookie attributes needed to recreate a cookie with requests.cookies.create_cookie
+COOKIE_ATTRIBUTES = ('name', 'value', 'domain',
+                     'path', 'secure', 'expires', 'port')
+
+
+class SessionStore:
+    """ SQLite backed session store. Sessions are looked up by a keyed hash of the email and
+        encrypted with a key derived from the password, so the store is useless without the credentials. """
+
+    def __init__(self, path=SESSION_STORE_PATH, ttl=SESSION_STORE_TTL, secret=SESSION_STORE_SECRET):
+        self.path = path
+        self.ttl = ttl
+        self.secret = secret
+
+        # sqlite3 connections can't be shared between threads
+        self._local = threading.local()
+
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                               'account TEXT PRIMARY KEY, '
+                               'payload BLOB NOT NULL, '
+                               'expires_at REAL NOT NULL)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+
+        return connection
+
+    def _account(self, email):
+        return hmac.new(self.secret, email.strip().lower().encode(), hashlib.sha256).hexdigest()
+
+    def _fernet(self, email, password):
+        key = hashlib.pbkdf2_hmac('sha256', password.encode(), self.secret + email.strip().lower().encode(),
+                                  SESSION_STORE_KEY_ITERATIONS)
+        return Fernet(base64.urlsafe_b64encode(key))
+
+    def load(self, email, password):
+        """ Returns (cookie jar, async token) of the stored session or None """
+
+        row = self._connection().execute(
+            'SELECT payload FROM sessions WHERE account = ? AND expires_at > ?',
+            (self._account(email), time.time())).fetchone()
+
+        if row is None:
+            return None
+
+        try:
+            session = json.loads(self._fernet(email, password).decrypt(row[0]))
+        except (InvalidToken, ValueError):
+            return None
+
+        cookie_jar = requests.cookies.RequestsCookieJar()
+        for cookie in session['cookies']:
+            cookie_jar.set_cookie(requests.cookies.create_cookie(**cookie))
+
+        return cookie_jar, session['async_token']
+
+    def save(self, email, password, cookie_jar, async_token):
+        now = time.time()
+
+        session = {
+            'cookies': [{attribute: getattr(cookie, attribute) for attribute in COOKIE_ATTRIBUTES}
+                        for cookie in cookie_jar],
+            'async_token': async_token
+        }
+        payload = self._fernet(email, password).encrypt(
+            json.dumps(session).encode())
+
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO sessions (account, payload, expires_at) VALUES (?, ?, ?)',
+                               (self._account(email), payload, now + self.ttl))
+            connection.execute(
+                'DELETE FROM sessions WHERE expires_at <= ?', (now,))
+
+    def delete(self, email):
+        with self._connection() as connection:
+            connection.execute(
+                'DELETE FROM sessions WHERE account = ?', (self._account(email),))
+
+
+__session_store = None
+__session_store_lock = threading.Lock()
+
+
+def get_session_store():
+    """ Returns the process wide session store """
+
+    global __session_store
+
+    with __session_store_lock:
+        if __session_store is None:
+            __session_store = SessionStore()
+
+    return __session_store
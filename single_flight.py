@@ -0,0 +1,44 @@
+""" Coalescing of identical concurrent calls (single flight) """
+
+import asyncio
+import functools
+
+import metrics
+
+
+class AsyncSingleFlight:
+    """ Runs at most one call of a coroutine function per key at a time, callers arriving while it runs wait for and
+        share its result (or exception). Calls are made on a single event loop, each one runs as a task of its own
+        so a caller giving up (or being cancelled) doesn't cancel it for the others. """
+
+    def __init__(self, name):
+        # Name of the call in the bdays_coalesced_calls_total metric
+        self.name = name
+        self._calls = {}
+
+    def start(self, key, fn, *args, **kwargs):
+        """ Returns the task of the call with key in flight, starting fn(*args, **kwargs) as that call if there is none.
+            Await it with asyncio.shield, cancelling the task itself would cancel it for every caller. """
+
+        task = self._calls.get(key)
+
+        if task is not None:
+            metrics.increment('bdays_coalesced_calls_total', call=self.name)
+            return task
+
+        task = self._calls[key] = asyncio.ensure_future(fn(*args, **kwargs))
+        task.add_done_callback(functools.partial(self._forget, key))
+
+        return task
+
+    async def do(self, key, fn, *args, **kwargs):
+        """ Returns await fn(*args, **kwargs), or the result of the call with the same key already in flight """
+
+        return await asyncio.shield(self.start(key, fn, *args, **kwargs))
+
+    def _forget(self, key, task):
+        del self._calls[key]
+
+        # Every caller may have given up on it, don't log its exception as never retrieved
+        if not task.cancelled():
+            task.exception()
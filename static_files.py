@@ -0,0 +1,170 @@
+""" Precompressed, cache friendly serving of the frontend build (./dist)
+
+    python static_files.py dist
+
+    Run after every frontend build (yarn build runs it as postbuild). Next to every compressible file it writes a
+    gzip and, with the brotli package installed, a brotli variant, and records the content hash of every file in
+    dist/static-manifest.json. StaticFiles serves from that manifest without touching the files' contents.
+"""
+
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import sys
+import threading
+
+from flask import Response, render_template, request, send_file, send_from_directory
+
+from compression import ENCODINGS, MAX_COMPRESSION_LEVELS, available_encodings, compress, negotiate_encoding
+
+STATIC_MANIFEST_NAME = 'static-manifest.json'
+
+# Images and fonts are compressed already
+COMPRESSIBLE_EXTENSIONS = ('.html', '.js', '.css', '.map',
+                           '.json', '.svg', '.txt', '.ico')
+
+# Smaller files aren't worth a variant
+COMPRESS_MIN_SIZE = 256
+
+# Vue CLI puts a content hash in the names of the bundles (e.g. js/app.3f2a1b9c.js), such a file never changes
+HASHED_FILE_NAME_REGEXP = re.compile(r'\.[0-9a-f]{8,}\.\w+$')
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Files without a hashed name (index.html, favicon.ico) are revalidated with their ETag on every use
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def precompress_directory(directory):
+    """ Write the compressed variants and the manifest of the files of directory, returns the manifest.
+        The manifest maps every file path (relative, with / separators) to its content hash, size,
+        whether its name is hashed and the size of each of its variants. """
+
+    manifest = {}
+    variant_suffixes = tuple(suffix for _, suffix in ENCODINGS)
+
+    for root, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            relative_path = os.path.relpath(
+                path, directory).replace(os.sep, '/')
+
+            if relative_path == STATIC_MANIFEST_NAME or file_name.endswith(variant_suffixes):
+                continue
+
+            with open(path, 'rb') as static_file:
+                data = static_file.read()
+
+            entry = {'etag': content_hash(data), 'size': len(data),
+                     'immutable': bool(HASHED_FILE_NAME_REGEXP.search(file_name)), 'encodings': {}}
+
+            if file_name.endswith(COMPRESSIBLE_EXTENSIONS) and len(data) >= COMPRESS_MIN_SIZE:
+                for encoding, suffix in available_encodings():
+                    compressed = compress(
+                        data, encoding, MAX_COMPRESSION_LEVELS[encoding])
+
+                    # Only keep variants that are actually smaller
+                    if len(compressed) < len(data):
+                        with open(path + suffix, 'wb') as variant_file:
+                            variant_file.write(compressed)
+                        entry['encodings'][encoding] = len(compressed)
+
+            manifest[relative_path] = entry
+
+    with open(os.path.join(directory, STATIC_MANIFEST_NAME), 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def load_manifest(directory):
+    """ Returns the manifest of directory, empty if it wasn't precompressed """
+
+    try:
+        with open(os.path.join(directory, STATIC_MANIFEST_NAME), encoding='utf-8') as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+class StaticFiles:
+    """ Responses for the files of a precompressed directory and its rendered index.html template """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.manifest = load_manifest(self.directory)
+        self._index = None
+        self._index_lock = threading.Lock()
+
+    def response(self, relative_path):
+        """ Response of a file, the precompressed variant the client accepts and 304 if it already has it """
+
+        entry = self.manifest.get(relative_path)
+
+        if entry is None:
+            # Not precompressed (or not there at all), Flask revalidates it with its own ETag
+            return send_from_directory(self.directory, relative_path, max_age=0)
+
+        encoding = negotiate_encoding(
+            request.accept_encodings, entry['encodings'])
+        path = os.path.join(self.directory, *relative_path.split('/'))
+        if encoding:
+            path += dict(ENCODINGS)[encoding]
+
+        response = send_file(path, mimetype=mimetypes.guess_type(relative_path)[0] or 'application/octet-stream',
+                             etag=f'{entry["etag"]}-{encoding}' if encoding else entry['etag'], conditional=True)
+
+        return self._finish(response, encoding, entry['encodings'], entry['immutable'])
+
+    def index_response(self):
+        """ Response of index.html, rendered and compressed once per process """
+
+        with self._index_lock:
+            if self._index is None:
+                body = render_template('index.html').encode()
+                variants = {encoding: compress(body, encoding, MAX_COMPRESSION_LEVELS[encoding])
+                            for encoding, _ in available_encodings()}
+                variants[None] = body
+                self._index = content_hash(body), variants
+
+        etag, variants = self._index
+        encoding = negotiate_encoding(request.accept_encodings, variants)
+
+        response = Response(variants[encoding], mimetype='text/html')
+        response.set_etag(f'{etag}-{encoding}' if encoding else etag)
+
+        return self._finish(response, encoding, variants, False).make_conditional(request)
+
+    def _finish(self, response, encoding, encodings, immutable):
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if encodings:
+            response.vary.add('Accept-Encoding')
+
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+        response.headers.pop('Expires', None)
+
+        return response
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.exit(__doc__)
+
+    manifest = precompress_directory(sys.argv[1])
+
+    size = sum(entry['size'] for entry in manifest.values())
+    compressed_size = sum(min([entry['size'], *entry['encodings'].values()])
+                          for entry in manifest.values())
+    print(f'{len(manifest)} files, {size} bytes, {compressed_size} bytes compressed '
+          f'({", ".join(encoding for encoding, _ in available_encodings())})')
+
+
+if __name__ == '__main__':
+    main()
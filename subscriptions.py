@@ -0,0 +1,356 @@
+""" Calendar subscriptions: secret feed URLs for calendar apps to poll.
+    Feeds are scraped ahead of time by a background scheduler and stored precomputed (and precompressed),
+    so reading one is a single lookup no matter how many clients poll it. """
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import secrets
+import sqlite3
+import threading
+import time
+from concurrent.futures import wait
+
+from cryptography.fernet import Fernet, InvalidToken
+
+import async_bdays
+import metrics
+from bdays import MONTH_WINDOW, failure_reason
+from compression import MAX_COMPRESSION_LEVELS, available_encodings, compress
+
+# The only copy of every subscription, unlike the caches it must not be kept somewhere that is cleaned up (e.g. /tmp)
+SUBSCRIPTIONS_PATH = os.environ.get('SUBSCRIPTIONS_PATH', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'data', 'subscriptions.sqlite3'))
+
+# Secret the stored credentials are encrypted with, subscribing is disabled without it.
+# Subscriptions stored with another secret can't be refreshed anymore and expire.
+SUBSCRIPTIONS_SECRET = os.environ.get('SUBSCRIPTIONS_SECRET', '').encode() or None
+
+# Calendars advertise X-PUBLISHED-TTL:PT12H, feeds are refreshed well before that
+SUBSCRIPTION_REFRESH_INTERVAL = 10 * 60 * 60
+
+# Every refresh is brought forward by a random part of this so refreshes spread out instead of bunching up
+SUBSCRIPTION_REFRESH_JITTER = 60 * 60
+
+# First retry of a failed refresh, doubled after every consecutive failure up to the refresh interval
+SUBSCRIPTION_RETRY_DELAY = 5 * 60
+
+# Feeds not refreshed for this long (their refreshes keep failing) aren't served anymore, their subscription is
+# deleted on the next failure
+SUBSCRIPTION_FEED_MAX_AGE = 3 * 24 * 60 * 60
+
+# Seconds a claimed refresh belongs to the process that claimed it, after that another process may retry it
+SUBSCRIPTION_REFRESH_LEASE = 15 * 60
+
+# Seconds between looks for due subscriptions and subscriptions refreshed at once by each process
+SUBSCRIPTION_SCHEDULER_INTERVAL = 30
+SUBSCRIPTION_REFRESH_CONCURRENCY = int(
+    os.environ.get('SUBSCRIPTION_REFRESH_CONCURRENCY', 4))
+
+logger = logging.getLogger(__name__)
+
+
+def next_refresh_delay():
+    return SUBSCRIPTION_REFRESH_INTERVAL - random.uniform(0, SUBSCRIPTION_REFRESH_JITTER)
+
+
+def retry_delay(failures):
+    delay = min(SUBSCRIPTION_RETRY_DELAY * 2 ** (failures - 1),
+                SUBSCRIPTION_REFRESH_INTERVAL)
+    return delay * random.uniform(0.75, 1)
+
+
+class SubscriptionsDisabled(Exception):
+    """ Raised when subscribing without SUBSCRIPTIONS_SECRET set """
+
+
+class Feed:
+    """ Precomputed feed of a subscription, body is encoded with encoding (None for uncompressed) """
+
+    def __init__(self, body, encoding, etag, refreshed_at, next_refresh_at):
+        self.body = body
+        self.encoding = encoding
+        self.etag = etag
+        self.refreshed_at = refreshed_at
+        self.next_refresh_at = next_refresh_at
+
+
+class Subscription:
+    """ Subscription claimed for a refresh """
+
+    def __init__(self, token_hash, email, password, first_month, months, failures):
+        self.token_hash = token_hash
+        self.email = email
+        self.password = password
+        self.first_month = first_month
+        self.months = months
+        self.failures = failures
+
+
+class SubscriptionStore:
+    """ SQLite backed store of subscriptions and their feeds, shared by every process.
+        Subscriptions are looked up by a hash of their token (the token itself is never stored)
+        and the credentials needed for refreshing are encrypted with the server secret.
+        Without a secret existing feeds are still served, but nothing can be subscribed or refreshed. """
+
+    def __init__(self, path=SUBSCRIPTIONS_PATH, secret=SUBSCRIPTIONS_SECRET):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._fernet = Fernet(base64.urlsafe_b64encode(
+            hmac.new(secret, b'subscription credentials', hashlib.sha256).digest())) if secret else None
+
+        # sqlite3 connections can't be shared between threads
+        self._local = threading.local()
+
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS subscriptions ('
+                               'token_hash TEXT PRIMARY KEY, '
+                               'credentials BLOB NOT NULL, '
+                               'first_month INTEGER NOT NULL, '
+                               'months INTEGER NOT NULL, '
+                               'created_at REAL NOT NULL, '
+                               'next_refresh_at REAL NOT NULL, '
+                               'failures INTEGER NOT NULL DEFAULT 0, '
+                               'last_error TEXT, '
+                               'etag TEXT NOT NULL, '
+                               'refreshed_at REAL NOT NULL, '
+                               'body BLOB NOT NULL, '
+                               'body_gzip BLOB, '
+                               'body_br BLOB)')
+            connection.execute('CREATE INDEX IF NOT EXISTS subscriptions_next_refresh_at '
+                               'ON subscriptions (next_refresh_at)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+
+        return connection
+
+    @staticmethod
+    def _token_hash(token):
+        # Tokens are random enough that an unkeyed hash can't be reversed
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    @staticmethod
+    def _feed_columns(body):
+        """ Returns the feed columns (etag, body, body_gzip, body_br) of a calendar """
+
+        data = body.encode()
+        encoded = {encoding: compress(data, encoding, MAX_COMPRESSION_LEVELS[encoding])
+                   for encoding, _ in available_encodings()}
+
+        return hashlib.sha256(data).hexdigest()[:32], data, encoded.get('gzip'), encoded.get('br')
+
+    @property
+    def enabled(self):
+        """ Whether there is a secret to encrypt and decrypt credentials with """
+        return self._fernet is not None
+
+    def create(self, email, password, body, first_month=0, months=MONTH_WINDOW):
+        """ Subscribe an account with its current calendar body, returns the secret token of the feed """
+
+        if not self.enabled:
+            raise SubscriptionsDisabled()
+
+        token = secrets.token_urlsafe(32)
+        credentials = self._fernet.encrypt(json.dumps(
+            {'email': email, 'password': password}).encode())
+        etag, data, body_gzip, body_br = self._feed_columns(body)
+        now = time.time()
+
+        with self._connection() as connection:
+            connection.execute('INSERT INTO subscriptions (token_hash, credentials, first_month, months, created_at, '
+                               'next_refresh_at, etag, refreshed_at, body, body_gzip, body_br) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (self._token_hash(token), credentials, first_month, months, now,
+                                now + next_refresh_delay(), etag, now, data, body_gzip, body_br))
+
+        return token
+
+    def delete(self, token):
+        """ Unsubscribe, returns whether there was such a subscription """
+
+        with self._connection() as connection:
+            return connection.execute('DELETE FROM subscriptions WHERE token_hash = ?',
+                                      (self._token_hash(token),)).rowcount > 0
+
+    def feed(self, token, encoding=None):
+        """ Returns the Feed of token encoded with encoding if there is such a variant,
+            None for an unknown token or an expired feed (see SUBSCRIPTION_FEED_MAX_AGE) """
+
+        columns = 'etag, refreshed_at, next_refresh_at, body'
+        if encoding is not None:
+            columns += f', body_{encoding}'
+
+        row = self._connection().execute(f'SELECT {columns} FROM subscriptions '
+                                         'WHERE token_hash = ? AND refreshed_at > ?',
+                                         (self._token_hash(token), time.time() - SUBSCRIPTION_FEED_MAX_AGE)).fetchone()
+
+        if row is None:
+            return None
+
+        etag, refreshed_at, next_refresh_at, body = row[:4]
+
+        if encoding is not None and row[4] is not None:
+            return Feed(row[4], encoding, etag, refreshed_at, next_refresh_at)
+
+        return Feed(body, None, etag, refreshed_at, next_refresh_at)
+
+    def claim_due(self, limit):
+        """ Returns up to limit Subscriptions due for a refresh, leased to the caller so no other process refreshes them """
+
+        now = time.time()
+        connection = self._connection()
+
+        # Take the write lock up front, the claimed rows must not be claimed by anyone else in the meantime
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute('SELECT token_hash, credentials, first_month, months, failures '
+                                      'FROM subscriptions WHERE next_refresh_at <= ? '
+                                      'ORDER BY next_refresh_at LIMIT ?', (now, limit)).fetchall()
+            connection.executemany('UPDATE subscriptions SET next_refresh_at = ? WHERE token_hash = ?',
+                                   [(now + SUBSCRIPTION_REFRESH_LEASE, row[0]) for row in rows])
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+
+        subscriptions = []
+
+        for token_hash, credentials, first_month, months, failures in rows:
+            try:
+                credentials = json.loads(self._fernet.decrypt(credentials))
+            except (InvalidToken, ValueError):
+                # Encrypted with another secret, nothing to do but keep serving the last feed
+                self.record_failure(token_hash, failures + 1,
+                                    'credentials_unreadable')
+                continue
+
+            subscriptions.append(Subscription(token_hash, credentials['email'], credentials['password'],
+                                              first_month, months, failures))
+
+        return subscriptions
+
+    def write_feed(self, token_hash, body):
+        """ Store the refreshed calendar of a subscription and schedule its next refresh """
+
+        etag, data, body_gzip, body_br = self._feed_columns(body)
+        now = time.time()
+
+        with self._connection() as connection:
+            connection.execute('UPDATE subscriptions SET etag = ?, refreshed_at = ?, body = ?, body_gzip = ?, '
+                               'body_br = ?, next_refresh_at = ?, failures = 0, last_error = NULL '
+                               'WHERE token_hash = ?',
+                               (etag, now, data, body_gzip, body_br, now + next_refresh_delay(), token_hash))
+
+    def record_failure(self, token_hash, failures, reason):
+        """ Schedule a retry of a failed refresh, the last feed is served until one succeeds.
+            A subscription whose feed has expired (see SUBSCRIPTION_FEED_MAX_AGE) is deleted instead. """
+
+        now = time.time()
+
+        with self._connection() as connection:
+            if connection.execute('DELETE FROM subscriptions WHERE token_hash = ? AND refreshed_at <= ?',
+                                  (token_hash, now - SUBSCRIPTION_FEED_MAX_AGE)).rowcount:
+                metrics.increment('bdays_subscriptions_expired_total', reason=reason)
+                return
+
+            connection.execute('UPDATE subscriptions SET failures = ?, last_error = ?, next_refresh_at = ? '
+                               'WHERE token_hash = ?',
+                               (failures, reason, now + retry_delay(failures), token_hash))
+
+
+class SubscriptionScheduler:
+    """ Background thread refreshing due subscriptions on the scrape event loop (see async_bdays.py).
+        Every process may run one, claims in the shared store keep them from refreshing the same subscription.
+        Without a store it uses the process wide one, opened when the scheduler is started. """
+
+    def __init__(self, store=None, interval=SUBSCRIPTION_SCHEDULER_INTERVAL, concurrency=SUBSCRIPTION_REFRESH_CONCURRENCY):
+        self.store = store
+        self.interval = interval
+        self.concurrency = concurrency
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        """ Start the scheduler thread of this process if it isn't running yet (threads don't survive a fork).
+            Without a secret there is nothing it could refresh, so it isn't started. """
+
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self.store is None:
+                self.store = get_subscription_store()
+
+            if self._pid != os.getpid():
+                if self.store.enabled:
+                    threading.Thread(target=self._run, name='subscription-scheduler',
+                                     daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            try:
+                refreshed = self.run_once()
+            except Exception:
+                logger.exception('Refreshing subscriptions failed')
+                refreshed = 0
+
+            # Keep going while there is a backlog
+            if refreshed < self.concurrency:
+                time.sleep(self.interval * random.uniform(0.5, 1.5))
+
+    def run_once(self):
+        """ Refresh the due subscriptions (up to concurrency of them), returns how many were claimed """
+
+        subscriptions = self.store.claim_due(self.concurrency)
+        wait([async_bdays.submit(self.refresh(subscription))
+              for subscription in subscriptions])
+
+        return len(subscriptions)
+
+    async def refresh(self, subscription):
+        loop = asyncio.get_running_loop()
+
+        try:
+            body = await async_bdays.get_birthdays_async(subscription.email, subscription.password,
+                                                         first_month=subscription.first_month,
+                                                         months=subscription.months)
+        except Exception as e:
+            reason = failure_reason(e)
+            metrics.increment('bdays_subscription_refreshes_total',
+                              result='failed', reason=reason)
+            await loop.run_in_executor(None, self.store.record_failure, subscription.token_hash,
+                                       subscription.failures + 1, reason)
+            return
+
+        metrics.increment('bdays_subscription_refreshes_total', result='ok')
+
+        # Compressing at the best levels and SQLite are both too slow for the event loop
+        await loop.run_in_executor(None, self.store.write_feed, subscription.token_hash, body)
+
+
+__subscription_store = None
+__subscription_store_lock = threading.Lock()
+
+
+def get_subscription_store():
+    """ Returns the process wide subscription store """
+
+    global __subscription_store
+
+    with __subscription_store_lock:
+        if __subscription_store is None:
+            __subscription_store = SubscriptionStore()
+
+    return __subscription_store
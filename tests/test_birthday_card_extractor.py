@@ -0,0 +1,119 @@
+""" Streaming split of birthday async responses into cards, wherever the chunks of the response are cut
+
+    python -m unittest discover tests
+"""
+
+import json
+import random
+import unittest
+
+from bdays import BirthdayCardExtractor, ScrapeError
+
+CARD_START = 'class="_43q7"'
+
+
+def card_html(index, name):
+    return (f'<li {CARD_START}><a href="https://www.facebook.com/friend.{index}" data-hover="tooltip" '
+            f'data-tooltip-content="{name} (03/{index + 1:02d})"><img class="_s0" alt="{name}" /></a></li>')
+
+
+def birthday_async_response(cards, ensure_ascii=True, tail=None):
+    """ Raw birthday async response holding cards, tail is appended to the JSON after the card HTML """
+
+    payload = {'domops': [['replace', '#birthdays_monthly_card', False,
+                           {'__html': f'<ul class="_43q6">{"".join(cards)}</ul>'}]]}
+    if tail is not None:
+        payload['jsmods'] = tail
+
+    return f'for (;;);{json.dumps(payload, ensure_ascii=ensure_ascii)}'.encode()
+
+
+def expected_cards(cards):
+    """ HTML of each card as split by the extractor, from the start of one card to the start of the next,
+        the last one runs to the end of the card HTML """
+
+    return [CARD_START + card for card in f'<ul class="_43q6">{"".join(cards)}</ul>'.split(CARD_START)[1:]]
+
+
+def extract(response, chunk_sizes):
+    extractor = BirthdayCardExtractor()
+    extracted = []
+    start = 0
+
+    for chunk_size in chunk_sizes:
+        extracted += extractor.feed(response[start:start + chunk_size])
+        start += chunk_size
+
+    extracted += extractor.feed(response[start:])
+    extracted += extractor.finish()
+
+    return extractor, extracted
+
+
+class BirthdayCardExtractorTest(unittest.TestCase):
+
+    NAMES = ['Anna Kovács', 'Jo &quot;Q&quot; Public', 'Back\\slash "quoted"', 'Zoë 李 😀', 'Tab\tand\nnewline']
+
+    def test_whole_response(self):
+        cards = [card_html(index, name) for index, name in enumerate(self.NAMES)]
+        extractor, extracted = extract(birthday_async_response(cards), [])
+
+        self.assertTrue(extractor.saw_card_html)
+        self.assertEqual(extracted, expected_cards(cards))
+
+    def test_chunk_boundaries(self):
+        cards = [card_html(index, name) for index, name in enumerate(self.NAMES)]
+
+        for ensure_ascii in (True, False):
+            response = birthday_async_response(cards, ensure_ascii, tail={'require': [['Bootloader', 'x']]})
+
+            for chunk_size in range(1, 64):
+                with self.subTest(ensure_ascii=ensure_ascii, chunk_size=chunk_size):
+                    _, extracted = extract(response, [chunk_size] * (len(response) // chunk_size))
+                    self.assertEqual(extracted, expected_cards(cards))
+
+    def test_random_chunk_boundaries(self):
+        generator = random.Random(0)
+        cards = [card_html(index, generator.choice(self.NAMES)) for index in range(40)]
+        response = birthday_async_response(cards, ensure_ascii=False)
+
+        for _ in range(200):
+            chunk_sizes = [generator.randint(1, 300) for _ in range(len(response) // 100)]
+            self.assertEqual(extract(response, chunk_sizes)[1], expected_cards(cards))
+
+    def test_no_cards(self):
+        extractor, extracted = extract(birthday_async_response([]), [7] * 20)
+
+        self.assertTrue(extractor.saw_card_html)
+        self.assertEqual(extracted, [])
+
+    def test_not_a_birthday_async_response(self):
+        extractor, extracted = extract(b'for (;;);{"error": 1357001}', [5] * 5)
+
+        self.assertFalse(extractor.saw_card_html)
+        self.assertEqual(extracted, [])
+
+    def test_rest_of_response_ignored(self):
+        # Markup after the card HTML isn't a card and isn't kept around while the rest of the response streams in
+        cards = [card_html(0, 'Anna Kovács')]
+        tail = [f'<div {CARD_START}>not a card</div>' * 1000]
+        response = birthday_async_response(cards, tail=tail)
+        html_end = response.index(b'</ul>') + len(b'</ul>"')
+
+        extractor = BirthdayCardExtractor()
+        extracted = extractor.feed(response[:html_end])
+
+        for start in range(html_end, len(response), 16):
+            extracted += extractor.feed(response[start:start + 16])
+            self.assertEqual(extractor._buffer, '')
+
+        self.assertEqual(extracted + extractor.finish(), expected_cards(cards))
+
+    def test_invalid_escape(self):
+        with self.assertRaises(ScrapeError) as raised:
+            extract(b'{"__html": "<li class=\\"_43q7\\">\\x</li>"}', [9] * 3)
+        self.assertEqual(raised.exception.reason, 'async_birthdays_response_invalid')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+""" Compatibility of the streamed ics calendar with the ics.Calendar based serializer it replaced
+
+    python -m unittest discover tests
+"""
+
+import re
+import unittest
+from datetime import date, timedelta
+
+import ics
+from ics import Calendar, Event
+
+from bdays import Birthday, serialize_birthdays_calendar
+
+EVENT_REGEXP = re.compile(r'BEGIN:VEVENT\r.*?END:VEVENT\r', re.DOTALL)
+
+
+def populate_birthdays_calendar(birthdays, today):
+    """ Calendar of the ics.Calendar based serializer, as it was before serialize_birthdays_calendar """
+
+    c = Calendar()
+    c.scale = 'GREGORIAN'
+    c.method = 'PUBLISH'
+    c.creator = f'fb2cal'
+    c._unused.append(ics.parse.ContentLine(name='X-WR-CALNAME',
+                                           params={}, value='Facebook Birthdays (fb2cal)'))
+    c._unused.append(ics.parse.ContentLine(
+        name='X-PUBLISHED-TTL', params={}, value='PT12H'))
+    c._unused.append(ics.parse.ContentLine(
+        name='X-ORIGINAL-URL', params={}, value='/events/birthdays/'))
+
+    for birthday in birthdays:
+        e = Event()
+        e.uid = birthday.uid
+        e.name = f"{birthday.name}'s Birthday"
+
+        year = today.year if birthday.month >= today.month else today.year + 1
+        month = '{:02d}'.format(birthday.month)
+        day = '{:02d}'.format(birthday.day)
+        e.begin = f'{year}-{month}-{day} 00:00:00'
+        e.make_all_day()
+        e.duration = timedelta(days=1)
+        e._unused.append(ics.parse.ContentLine(
+            name='RRULE', params={}, value='FREQ=YEARLY'))
+
+        c.events.add(e)
+
+    return ''.join([line.rstrip('\n') for line in c])
+
+
+def split_calendar(calendar):
+    """ Returns the calendar without its events and its sorted events, ics.Calendar doesn't keep the order of events """
+
+    return EVENT_REGEXP.sub('', calendar), sorted(EVENT_REGEXP.findall(calendar))
+
+
+class SerializeBirthdaysCalendarTest(unittest.TestCase):
+
+    def assertCompatible(self, birthdays, today):
+        calendar = ''.join(serialize_birthdays_calendar(birthdays, today))
+
+        self.assertEqual(split_calendar(calendar),
+                         split_calendar(populate_birthdays_calendar(birthdays, today)))
+
+    def test_events(self):
+        today = date.today()
+        birthdays = [Birthday(str(100000 + index), f'Friend {index}', index % 28 + 1, index % 12 + 1)
+                     for index in range(50)]
+
+        self.assertCompatible(birthdays, today)
+
+    def test_past_and_upcoming_months(self):
+        # Months before the current one are placed in the next year
+        birthdays = [Birthday(str(month), f'Friend {month}', 15, month)
+                     for month in range(1, 13)]
+
+        self.assertCompatible(birthdays, date(2021, 6, 20))
+
+    def test_escaped_names(self):
+        names = ['Anna Kovács', "O'Neil, Jr; Sr", 'Back\\slash', 'Zoë 李', 'Jo & Co']
+        birthdays = [Birthday(str(index), name, index + 1, 3)
+                     for index, name in enumerate(names)]
+
+        self.assertCompatible(birthdays, date(2021, 1, 10))
+
+    def test_no_birthdays(self):
+        self.assertCompatible([], date.today())
+
+
+if __name__ == '__main__':
+    unittest.main()
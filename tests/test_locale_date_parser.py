@@ -0,0 +1,102 @@
+""" Compatibility of LocaleDateParser with the strptime based tooltip parsing it replaced
+
+    python -m unittest discover tests
+"""
+
+import unittest
+from calendar import monthrange
+from datetime import date, datetime
+
+from bdays import LOCALE_DATE_FORMAT_MAPPING, LocaleDateParser, ScrapeError
+
+NAME = 'Anna O&#039;Brien'
+
+
+def strptime_day_month(tooltip_content, name, date_format):
+    """ Day and month of a dated tooltip as parsed before LocaleDateParser, None where strptime failed """
+
+    birthday_date_str = tooltip_content
+
+    for string in [name, '(', ')', '&#x200f;', '&#x200e;', '&#x55d;']:
+        birthday_date_str = birthday_date_str.replace(string, '')
+
+    try:
+        parsed_date = datetime.strptime(birthday_date_str.strip(), date_format)
+    except ValueError:
+        return None
+
+    return (parsed_date.day, parsed_date.month)
+
+
+def tooltip(date_format, day, month, padded=True):
+    """ Tooltip content (HTML escaped, as in the birthday cards) of a date in date_format """
+
+    number_format = '{:02d}' if padded else '{}'
+    date_str = date_format.replace('%d', number_format.format(day)).replace('%m', number_format.format(month))
+
+    return f'{NAME} ({date_str})'
+
+
+class LocaleDateParserTest(unittest.TestCase):
+
+    def test_dates(self):
+        for user_locale, date_format in LOCALE_DATE_FORMAT_MAPPING.items():
+            parser = LocaleDateParser(user_locale)
+
+            for month in range(1, 13):
+                # strptime defaults to the year 1900, which has no 29th of February
+                for day in range(1, monthrange(1900, month)[1] + 1):
+                    for padded in (True, False):
+                        tooltip_content = tooltip(date_format, day, month, padded)
+
+                        with self.subTest(user_locale=user_locale, tooltip_content=tooltip_content):
+                            self.assertEqual(parser.parse(tooltip_content, NAME),
+                                             strptime_day_month(tooltip_content, NAME, date_format))
+
+    def test_direction_marks(self):
+        tooltip_content = f'&#x200f;{NAME}&#x200f; (&#x200e;24.12&#x200e;)'
+
+        self.assertEqual(LocaleDateParser('he_IL').parse(tooltip_content, NAME), (24, 12))
+        self.assertEqual(strptime_day_month(tooltip_content, NAME, LOCALE_DATE_FORMAT_MAPPING['he_IL']), (24, 12))
+
+    def test_invalid_dates(self):
+        parser = LocaleDateParser('en_US')
+
+        for date_str in ['13/01', '00/10', '04/31', '02/30', '1/2/3', '']:
+            tooltip_content = f'{NAME} ({date_str})'
+
+            with self.subTest(date_str=date_str):
+                self.assertIsNone(strptime_day_month(tooltip_content, NAME, '%m/%d'))
+
+                with self.assertRaises(ScrapeError) as raised:
+                    parser.parse(tooltip_content, NAME, today=date(2021, 6, 20))
+                self.assertEqual(raised.exception.reason, 'unparseable_tooltip')
+
+    def test_leap_day(self):
+        # Rejected by strptime, a birthday on the 29th of February was dropped before
+        tooltip_content = tooltip('%m/%d', 29, 2)
+
+        self.assertIsNone(strptime_day_month(tooltip_content, NAME, '%m/%d'))
+        self.assertEqual(LocaleDateParser('en_US').parse(tooltip_content, NAME), (29, 2))
+
+    def test_non_ascii_digits(self):
+        # Devanagari digits of 15/08
+        self.assertEqual(LocaleDateParser('hi_IN').parse(f'{NAME} (१५/०८)', NAME), (15, 8))
+
+    def test_day_names(self):
+        today = date(2021, 6, 20)
+
+        self.assertEqual(LocaleDateParser('en_US').parse(f'{NAME} (Tuesday)', NAME, today), (22, 6))
+        self.assertEqual(LocaleDateParser('hu_HU').parse(f'{NAME} (Szombat)', NAME, today), (26, 6))
+
+    def test_unsupported_locales(self):
+        # Their tooltips weren't seen yet, guessing the format could put birthdays on the wrong day
+        for user_locale in ['fa_IR', 'ps_AF', 'xx_XX']:
+            with self.subTest(user_locale=user_locale):
+                with self.assertRaises(ScrapeError) as raised:
+                    LocaleDateParser(user_locale)
+                self.assertEqual(raised.exception.reason, 'unsupported_locale')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+""" Transport settings (connection pool, timeouts and retries) of every scrape request and the endpoints they go to """
+
+import os
+import urllib.parse
+
+# Connections kept alive per host
+TRANSPORT_POOL_MAXSIZE = int(os.environ.get('TRANSPORT_POOL_MAXSIZE', 32))
+
+# Seconds to wait for a connection and between bytes of a response
+TRANSPORT_CONNECT_TIMEOUT = float(
+    os.environ.get('TRANSPORT_CONNECT_TIMEOUT', 5))
+TRANSPORT_READ_TIMEOUT = float(os.environ.get('TRANSPORT_READ_TIMEOUT', 20))
+
+# Retries of idempotent requests failing with a connection error or a transient status
+TRANSPORT_RETRIES = int(os.environ.get('TRANSPORT_RETRIES', 3))
+TRANSPORT_BACKOFF_FACTOR = 0.5
+TRANSPORT_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Maximum seconds of random jitter added to every backoff so retries of concurrent requests don't arrive in lockstep
+TRANSPORT_BACKOFF_JITTER = 0.5
+
+# Only these methods are retried, the login form POST is not
+TRANSPORT_RETRY_METHODS = frozenset(['GET', 'HEAD'])
+
+# URL path prefixes of the Facebook endpoints used by bdays.py
+ENDPOINT_PATH_PREFIXES = (
+    ('/login', 'login'),
+    ('/events/birthdays/', 'async_token'),
+    ('/ajax/settings/language/', 'locale'),
+    ('/async/birthdays/', 'async_birthdays'),
+    ('/ajax/mercury/composer_query.php', 'composer_query'),
+)
+
+
+def endpoint_name(url):
+    """ Classify a request URL into one of the Facebook endpoints, anything else is a profile page """
+
+    path = urllib.parse.urlsplit(url).path
+
+    for prefix, name in ENDPOINT_PATH_PREFIXES:
+        if path.startswith(prefix):
+            return name
+
+    return 'profile_page'
@@ -0,0 +1,129 @@
+""" Persistent vanity name -> Facebook uid cache shared between workers and processes """
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import metrics
+
+VANITY_CACHE_PATH = os.environ.get('VANITY_CACHE_PATH', os.path.join(
+    tempfile.gettempdir(), 'facebook-bdays-vanity-cache.sqlite3'))
+
+# Vanity names are rarely changed so resolved uids can be kept for a long time
+VANITY_CACHE_TTL = 30 * 24 * 60 * 60
+
+# Failed lookups are remembered for a shorter time in case the failure was transient
+VANITY_CACHE_NEGATIVE_TTL = 6 * 60 * 60
+
+VANITY_CACHE_MAX_ENTRIES = 100000
+
+# Returned by VanityCache.get when there is no usable entry
+MISS = object()
+
+
+class VanityCache:
+    """ SQLite backed cache mapping vanity names to uids.
+        A uid of None is stored for lookups that failed (negative caching). """
+
+    def __init__(self, path=VANITY_CACHE_PATH, ttl=VANITY_CACHE_TTL,
+                 negative_ttl=VANITY_CACHE_NEGATIVE_TTL, max_entries=VANITY_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self._counter_lock = threading.Lock()
+
+        # sqlite3 connections can't be shared between threads
+        self._local = threading.local()
+
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS vanity_cache ('
+                               'vanity_name TEXT PRIMARY KEY, '
+                               'uid TEXT, '
+                               'expires_at REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS vanity_cache_expires_at '
+                               'ON vanity_cache (expires_at)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            # WAL lets readers in other processes continue while one process writes
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+
+        return connection
+
+    def _count(self, hit):
+        with self._counter_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        metrics.increment('bdays_cache_requests_total', cache='vanity',
+                          result='hit' if hit else 'miss')
+
+    def get(self, vanity_name):
+        """ Returns cached uid (None for a cached failure) or MISS """
+
+        row = self._connection().execute(
+            'SELECT uid FROM vanity_cache WHERE vanity_name = ? AND expires_at > ?',
+            (vanity_name, time.time())).fetchone()
+
+        self._count(row is not None)
+
+        return row[0] if row is not None else MISS
+
+    def set(self, vanity_name, uid):
+        """ Store uid for vanity_name, uid None marks the lookup as failed """
+
+        now = time.time()
+        ttl = self.ttl if uid is not None else self.negative_ttl
+
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO vanity_cache (vanity_name, uid, expires_at) VALUES (?, ?, ?)',
+                               (vanity_name, uid, now + ttl))
+            self._evict(connection, now)
+
+    def _evict(self, connection, now):
+        """ Drop expired entries and keep the cache within max_entries by dropping the entries closest to expiry """
+
+        connection.execute(
+            'DELETE FROM vanity_cache WHERE expires_at <= ?', (now,))
+
+        (entry_count,) = connection.execute(
+            'SELECT COUNT(*) FROM vanity_cache').fetchone()
+
+        if entry_count > self.max_entries:
+            connection.execute('DELETE FROM vanity_cache WHERE vanity_name IN ('
+                               'SELECT vanity_name FROM vanity_cache ORDER BY expires_at LIMIT ?)',
+                               (entry_count - self.max_entries,))
+
+    def stats(self):
+        """ Returns hit/miss counters of this process """
+
+        with self._counter_lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+__vanity_cache = None
+__vanity_cache_lock = threading.Lock()
+
+
+def get_vanity_cache():
+    """ Returns the process wide vanity cache """
+
+    global __vanity_cache
+
+    with __vanity_cache_lock:
+        if __vanity_cache is None:
+            __vanity_cache = VanityCache()
+
+    return __vanity_cache